@@ -0,0 +1,107 @@
+# MIT License
+# 
+# Copyright (c) 2022 Dr John Vidler
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import time
+from importlib import import_module
+from importlib.util import find_spec
+from importlib.metadata import entry_points
+from Logging import Log
+
+ADDON_PATH = os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), "addons" )
+ENTRY_POINT_GROUP = "sdml.addons"
+
+class AddonRegistry:
+    """
+    Finds, imports and binds addons, once per process.
+
+    Addons are discovered from the addons package directory and from the 'sdml.addons' entry point group, imported
+    on first use and then kept, so later documents asking for the same addon cost only the bind. Time spent importing
+    and binding is recorded per addon for report().
+    """
+    def __init__( self ) -> None:
+        self.available = None # Name -> module path or entry point, filled in by discover()
+        self.modules = {}
+        self.importTime = {}
+        self.bindTime = {}
+        self.bindCount = {}
+
+    def discover( self ) -> dict:
+        if self.available is None:
+            self.available = {}
+            for f in sorted( os.listdir( ADDON_PATH ) ):
+                if f.endswith( '.py' ) and not f.startswith( '_' ):
+                    self.available[f[:-3]] = f"addons.{f[:-3]}"
+            try:
+                for point in entry_points( group=ENTRY_POINT_GROUP ):
+                    self.available.setdefault( point.name, point )
+            except TypeError: # Older importlib.metadata has no 'group' selection
+                for point in entry_points().get( ENTRY_POINT_GROUP, [] ):
+                    self.available.setdefault( point.name, point )
+        return self.available
+
+    def load( self, name: str ):
+        addon = self.modules.get( name )
+        if addon is None:
+            source = self.discover().get( name, f"addons.{name}" )
+            began = time.perf_counter()
+            addon = source.load() if hasattr( source, 'load' ) else import_module( source )
+            self.importTime[name] = time.perf_counter() - began
+            self.modules[name] = addon
+        return addon
+
+    def preload( self ):
+        """Imports every available addon now, rather than on first use"""
+        for name in self.discover():
+            self.load( name )
+
+    def path( self, name: str ) -> str:
+        """
+        The file an addon was (or would be) loaded from, for hashing it as a build input. Addons that haven't been
+        imported in this process, as with -j builds, are found from their module spec rather than by importing them.
+        """
+        addon = self.modules.get( name )
+        if addon is not None:
+            return getattr( addon, '__file__', None )
+
+        source = self.discover().get( name, f"addons.{name}" )
+        module = source.value.partition( ':' )[0].strip() if hasattr( source, 'load' ) else source
+        try:
+            spec = find_spec( module )
+        except (ImportError, ValueError):
+            return None
+        return spec.origin if spec is not None and spec.has_location else None
+
+    def bind( self, name: str, parser ):
+        addon = self.load( name )
+        began = time.perf_counter()
+        addon.bind( parser )
+        self.bindTime[name] = self.bindTime.get( name, 0 ) + time.perf_counter() - began
+        self.bindCount[name] = self.bindCount.get( name, 0 ) + 1
+        return addon
+
+    def report( self ):
+        for name in sorted( self.modules ):
+            count = self.bindCount.get( name, 0 )
+            Log.info( f"Addon {name}: imported in {self.importTime[name] * 1000:.2f}ms, bound {count} times in {self.bindTime.get( name, 0 ) * 1000:.2f}ms" )
+
+registry = AddonRegistry()
@@ -0,0 +1,380 @@
+# MIT License
+# 
+# Copyright (c) 2022 Dr John Vidler
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import io
+import os
+import json
+import asyncio
+import time
+import hashlib
+from fnmatch import fnmatch
+from collections import deque
+from functools import lru_cache
+from multiprocessing import Pool
+from Logging import Log
+from Lexer import Lexer, ENCODING
+from SDMLParser import Parser, VERSION
+from Cache import Cache
+from HTMLGenerator import Generator, AtomicWriter
+from Addons import registry
+from Profiler import Profiler
+
+MANIFEST_NAME = ".sdml-manifest.json"
+
+cache = None            # The parse cache for this process, if we have one
+roots = ( '.', 'output' ) # The source and build roots that outputs are placed relative to
+
+class BuildResult:
+    __slots__ = ( 'source', 'output', 'error', 'addons', 'cached', 'written', 'headings', 'profile' )
+
+    def __init__( self, source: str, output: str = None, error: str = None, addons: list = (), cached: bool = False, written: bool = False,
+                  headings: list = () ) -> None:
+        self.source = source
+        self.output = output # Where the rendered output went
+        self.error = error
+        self.addons = addons
+        self.cached = cached
+        self.written = written # False if the output was already up to date on disk
+        self.headings = headings # For the heading index, as the generator recorded them
+        self.profile = None    # The profiler's snapshot for this file, when profiling
+
+def hashFile( path: str ) -> str:
+    digest = hashlib.blake2b( digest_size=16 )
+    with open( path, 'rb' ) as f:
+        for chunk in iter( lambda: f.read( 1 << 20 ), b'' ):
+            digest.update( chunk )
+    return digest.hexdigest()
+
+@lru_cache( maxsize=None )
+def addonHash( addon: str ) -> str:
+    path = registry.path( addon )
+    return hashFile( path ) if path else None
+
+def outputPath( source: str, sourceRoot: str, buildRoot: str, extension: str = ".html" ) -> str:
+    """Where the built form of 'source' lives, mirroring its place under the source tree"""
+    relative = os.path.relpath( source, sourceRoot )
+    return os.path.join( buildRoot, os.path.splitext( relative )[0] + extension )
+
+def findSources( root: str, include = ( "*.sdml", ), exclude = (), ignore = () ):
+    """
+    Walks 'root' iteratively, yielding each file matching an 'include' glob as soon as it is found.
+
+    Globs are matched case-insensitively against both the file name and its path relative to 'root'. Anything
+    matching an 'exclude' glob is skipped (whole directories included), as is every path in 'ignore', such as the
+    build output directory. Directory entry types come straight from scandir, so most entries cost no extra stat.
+    """
+    include = [ pattern.lower() for pattern in include ]
+    exclude = [ pattern.lower() for pattern in exclude ]
+
+    # Directories are known by device and inode, so ignored ones are recognised (and symlink loops walked only once)
+    # with a single stat per directory, rather than resolving every path we see
+    visited = set()
+    for path in ignore:
+        try:
+            info = os.stat( path )
+            visited.add( (info.st_dev, info.st_ino) )
+        except OSError:
+            pass
+
+    def matches( patterns, entry, relative ):
+        name, relative = entry.name.lower(), relative.lower()
+        return any( fnmatch( name, pattern ) or fnmatch( relative, pattern ) for pattern in patterns )
+
+    pending = [ root ]
+    while pending:
+        directory = pending.pop()
+        try:
+            info = os.stat( directory )
+            if (info.st_dev, info.st_ino) in visited:
+                continue
+            visited.add( (info.st_dev, info.st_ino) )
+            entries = sorted( os.scandir( directory ), key=lambda entry: entry.name )
+        except OSError as e:
+            Log.warn( f"Skipping unreadable directory {directory}: {e}" )
+            continue
+
+        subdirectories = []
+        for entry in entries:
+            relative = os.path.relpath( entry.path, root )
+            if exclude and matches( exclude, entry, relative ):
+                continue
+            try:
+                if entry.is_dir():
+                    subdirectories.append( entry.path )
+                elif matches( include, entry, relative ):
+                    yield entry.path
+            except OSError as e:
+                Log.warn( f"Skipping unreadable entry {entry.path}: {e}" )
+
+        pending.extend( reversed( subdirectories ) ) # So we still walk in name order
+
+class Manifest:
+    """
+    Records, per source, what it was last successfully built from: its content hash (plus size and mtime, so
+    unchanged files are not even re-read), the addons it used and their own hashes, the SDML version that built it,
+    and where its output went.
+    """
+    def __init__( self, buildPath: str ) -> None:
+        self.path = os.path.join( buildPath, MANIFEST_NAME )
+        self.entries = {}
+        self.hashes = {} # Content hashes computed this run, so we never hash a file twice
+        if os.path.exists( self.path ):
+            try:
+                with open( self.path, 'r', encoding='utf-8' ) as f:
+                    self.entries = json.load( f )
+            except ValueError:
+                Log.warn( f"Build manifest {self.path} is unreadable, rebuilding everything" )
+
+    def sourceHash( self, source: str ) -> str:
+        if source not in self.hashes:
+            self.hashes[source] = hashFile( source )
+        return self.hashes[source]
+
+    def isCurrent( self, source: str ) -> bool:
+        entry = self.entries.get( source )
+        if not entry:
+            return False
+        if entry.get( 'version' ) != VERSION:
+            return False # Built by another version of SDML, whose output may differ
+        if not entry.get( 'output' ) or not os.path.exists( entry['output'] ):
+            return False # Deleted from the build directory, so it needs writing again whatever the source says
+
+        info = os.stat( source )
+        if info.st_size != entry['size']:
+            return False
+        if info.st_mtime_ns != entry['mtime']:
+            if self.sourceHash( source ) != entry['hash']:
+                return False
+            entry['mtime'] = info.st_mtime_ns # Touched but not changed, so remember that and skip the hash next time
+
+        for addon, digest in entry['addons'].items():
+            if addonHash( addon ) != digest:
+                return False
+        return True
+
+    def record( self, source: str, addons, output: str ):
+        info = os.stat( source )
+        self.entries[source] = {
+            'version': VERSION,
+            'size': info.st_size,
+            'mtime': info.st_mtime_ns,
+            'hash': self.sourceHash( source ),
+            'addons': { addon: addonHash( addon ) for addon in sorted(addons) },
+            'output': output
+        }
+
+    def prune( self, sources ) -> list:
+        """
+        Forgets every source that has been deleted, along with its old output. Returns the pruned sources.
+
+        'sources' are those this run found, which are kept without a stat. Anything else is only pruned if it is gone
+        from disk, so sources that were merely filtered out of this run keep their output.
+        """
+        keep = set( sources )
+        pruned = [ source for source in self.entries if source not in keep and not os.path.exists( source ) ]
+        for source in pruned:
+            output = self.entries.pop( source ).get( 'output' )
+            if output and os.path.exists( output ):
+                os.remove( output )
+        return pruned
+
+    def save( self ):
+        temp = f"{self.path}.tmp"
+        with open( temp, 'w', encoding='utf-8' ) as f:
+            json.dump( self.entries, f )
+        os.replace( temp, self.path )
+
+def initWorker( cachePath: str = None, sourceRoot: str = '.', buildRoot: str = 'output', profile: bool = False ):
+    global cache, roots
+    registry.preload() # So workers don't each pay for the import on their first '..use:'
+    cache = Cache( cachePath ) if cachePath else None
+    roots = ( sourceRoot, buildRoot )
+    Lexer.profiler = Parser.profiler = Profiler() if profile else None
+
+def parseFile( source: str, data: bytes = None ):
+    """
+    Parses 'source', via the cache if we have one. Returns the parse result, the addons used, and if it was cached.
+
+    If the source has already been read, pass its bytes as 'data' and it will be parsed from memory instead.
+    """
+
+    # Parses are cached by content and SDML version, then checked against the addons they actually used
+    key = None
+    if cache:
+        digest = hashFile( source ) if data is None else hashlib.blake2b( data, digest_size=16 ).hexdigest()
+        key = hashlib.blake2b( f"{VERSION}:{digest}".encode(), digest_size=16 ).hexdigest()
+        entry = cache.get( key )
+        if entry and all( addonHash( addon ) == digest for addon, digest in entry['addons'].items() ):
+            return entry['output'], sorted( entry['addons'] ), True
+
+    profiler = Parser.profiler
+    if profiler:
+        began = time.perf_counter()
+    lex = Lexer( source if data is None else io.StringIO( data.decode( ENCODING ), newline=None ) )
+    if profiler:
+        tokens = profiler.countTokens( lex )
+    try:
+        document = Parser( lex )
+        output = document.parse()
+    finally:
+        lex.close() # The lexer refers to itself through its bound stages, so don't leave the file to the cycle GC
+    if profiler:
+        profiler.file( source, began, time.perf_counter() - began, tokens[0] )
+
+    if cache:
+        cache.put( key, { 'addons': { addon: addonHash( addon ) for addon in document.used }, 'output': output } )
+    return output, sorted( document.used ), False
+
+def buildFile( source: str ) -> BuildResult:
+    try:
+        output = outputPath( source, *roots )
+        generator = Generator()
+        if cache is None and not Parser.profiler:
+            # Nothing needs the tree, so render straight from the parser's events instead of building one
+            lexer = Lexer( source )
+            try:
+                parser = Parser( lexer )
+                written = generator.stream( parser, output )
+            finally:
+                lexer.close()
+            return BuildResult( source, output, addons=sorted( parser.used ), written=written, headings=generator.headings )
+
+        document, addons, cached = parseFile( source )
+        written = generator.render( document, output )
+        result = BuildResult( source, output, addons=addons, cached=cached, written=written, headings=generator.headings )
+        if Parser.profiler:
+            result.profile = Parser.profiler.snapshot()
+        return result
+    except Exception as e:
+        return BuildResult( source, error=f"{type(e).__name__}: {e}" )
+    finally:
+        Log.flush() # Pool workers are terminated rather than exiting, so nothing may be left buffered between files
+
+def buildAll( sources, jobs: int = 1, cachePath: str = None, sourceRoot: str = '.', buildRoot: str = 'output', profile: bool = False ):
+    """
+    Builds each source into HTML under 'buildRoot', yielding a BuildResult per file in the order given. 'sources'
+    may be any iterable, so building can begin while it is still being produced.
+
+    With more than one job the files are spread over a pool of worker processes, each of which has its own lexer,
+    parser and addon state. If 'cachePath' is given, parse results are shared through the on-disk cache there, and
+    if 'profile' is set each result carries the profiler's counters for that file.
+    """
+    if jobs <= 1:
+        initWorker( cachePath, sourceRoot, buildRoot, profile )
+        for source in sources:
+            yield buildFile( source )
+        return
+
+    with Pool( jobs, initializer=initWorker, initargs=(cachePath, sourceRoot, buildRoot, profile) ) as pool:
+        yield from pool.imap( buildFile, sources, 4 )
+
+def readFile( source: str ) -> bytes:
+    with open( source, 'rb' ) as f:
+        return f.read()
+
+def writeFile( path: str, text: str ) -> bool:
+    writer = AtomicWriter( path )
+    try:
+        writer.write( text )
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit()
+
+async def buildAsync( sources, cachePath: str = None, sourceRoot: str = '.', buildRoot: str = 'output',
+                      prefetch: int = 16, backlog: int = 16 ):
+    """
+    Builds like buildAll(), on one core, but overlaps reading, parsing and writing.
+
+    Up to 'prefetch' sources are read ahead on I/O threads while the current one is parsed from memory, and up to
+    'backlog' rendered outputs may be queued for writing before parsing waits for the writes to catch up. Those two
+    limits cap memory use however large the tree is. Yields a BuildResult per file, in the order given.
+    """
+    initWorker( cachePath, sourceRoot, buildRoot )
+    sources = iter( sources )
+    reads = deque()
+    writes = deque()
+    exhausted = False
+
+    async def read( source: str ):
+        try:
+            return source, await asyncio.to_thread( readFile, source ), None
+        except OSError as e:
+            return source, None, f"{type(e).__name__}: {e}"
+
+    async def write( source: str, output: str, text: str, addons: list, cached: bool, titles: list ) -> BuildResult:
+        try:
+            written = await asyncio.to_thread( writeFile, output, text )
+            return BuildResult( source, output, addons=addons, cached=cached, written=written, headings=titles )
+        except OSError as e:
+            return BuildResult( source, error=f"{type(e).__name__}: {e}" )
+
+    async def failed( source: str, error: str ) -> BuildResult:
+        return BuildResult( source, error=error )
+
+    async def topUp():
+        nonlocal exhausted
+        while not exhausted and len(reads) < prefetch:
+            source = await asyncio.to_thread( next, sources, None ) # Walking the tree can block too
+            if source is None:
+                exhausted = True
+            else:
+                reads.append( asyncio.create_task( read( source ) ) )
+
+    await topUp()
+    while reads:
+        source, data, error = await reads.popleft()
+        await topUp()
+
+        if error:
+            writes.append( asyncio.create_task( failed( source, error ) ) )
+        else:
+            try:
+                document, addons, cached = parseFile( source, data )
+                generator = Generator()
+                text = ''.join( generator.chunks( document ) )
+                output = outputPath( source, *roots )
+                writes.append( asyncio.create_task( write( source, output, text, addons, cached, generator.headings ) ) )
+            except Exception as e:
+                writes.append( asyncio.create_task( failed( source, f"{type(e).__name__}: {e}" ) ) )
+
+        # Hand back whatever has finished, and hold off parsing more if the writes are falling behind
+        while writes and (writes[0].done() or len(writes) >= backlog):
+            yield await writes.popleft()
+
+    while writes:
+        yield await writes.popleft()
+
+def reportErrors( results: list ) -> int:
+    """Logs one summary of every failed build, returning the number of failures"""
+    failed = [ result for result in results if result.error ]
+    if failed:
+        Log.error( f"{len(failed)} of {len(results)} files failed to build:" )
+        for result in failed:
+            Log.error( f"  {result.source}: {result.error}" )
+    return len(failed)
+
+def reportCache( results: list, cachePath: str ):
+    """Logs the cache hit rate across every worker, then trims the cache back under its size cap"""
+    hits = sum( 1 for result in results if result.cached )
+    Log.info( f"Cache: {hits} hits, {len(results) - hits} misses" )
+    Cache( cachePath ).trim()
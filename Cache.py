@@ -0,0 +1,117 @@
+# MIT License
+# 
+# Copyright (c) 2022 Dr John Vidler
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import pickle
+import tempfile
+from Logging import Log
+
+CACHE_SIZE = int( os.getenv("SDML_CACHE_SIZE", 256 ) ) # In MiB
+
+class Cache:
+    """
+    A content-addressed store of pickled values, safe to share between processes.
+
+    Entries are written to a temporary file and renamed into place, so readers only ever see whole entries and
+    concurrent writers of the same key simply race to store identical data. Reads bump an entry's mtime, which trim()
+    uses to evict the least recently used entries once the cache grows past its size cap.
+    """
+    def __init__( self, path: str, limit: int = CACHE_SIZE * (1 << 20) ) -> None:
+        self.path = path
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        os.makedirs( path, exist_ok=True )
+
+    def entryPath( self, key: str ) -> str:
+        return os.path.join( self.path, key[:2], key )
+
+    def get( self, key: str ):
+        path = self.entryPath( key )
+        try:
+            with open( path, 'rb' ) as f:
+                value = pickle.load( f )
+            os.utime( path )
+        except FileNotFoundError: # Missing, or evicted out from under us
+            self.misses += 1
+            return None
+        except Exception as e:
+            # Truncated, or pickled against classes that have since moved. Either way it's no use, so let put() replace it
+            Log.warn( f"Discarding unreadable cache entry {key}: {type(e).__name__}: {e}" )
+            self.misses += 1
+            try:
+                os.remove( path )
+            except OSError:
+                pass
+            return None
+        self.hits += 1
+        return value
+
+    def put( self, key: str, value ):
+        directory = os.path.dirname( self.entryPath( key ) )
+        os.makedirs( directory, exist_ok=True )
+        handle, temp = tempfile.mkstemp( dir=directory, prefix='.' )
+        try:
+            with os.fdopen( handle, 'wb' ) as f:
+                pickle.dump( value, f, pickle.HIGHEST_PROTOCOL )
+            os.replace( temp, self.entryPath( key ) )
+            self.stores += 1
+        except Exception:
+            os.unlink( temp )
+            raise
+
+    def trim( self ) -> int:
+        """Evicts least recently used entries until the cache fits its size cap, returning how many were removed"""
+        entries = []
+        total = 0
+        for shard in os.scandir( self.path ):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir( shard.path ):
+                if entry.name.startswith( '.' ):
+                    continue
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append( (info.st_mtime_ns, info.st_size, entry.path) )
+                total += info.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+            try:
+                os.remove( path )
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        if removed:
+            Log.info( f"Evicted {removed} entries from the cache at {self.path}" )
+        return removed
+
+    def stats( self ) -> dict:
+        return { 'hits': self.hits, 'misses': self.misses, 'stores': self.stores }
@@ -20,6 +20,174 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
+import hashlib
+import secrets
+from Nodes import Node, Container, Document, Paragraph, Title, Text, Break
+from Index import Anchors
+from SDMLParser import Parser, Handler
+
+ESCAPE = str.maketrans( { '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;' } )
+BUFFER_SIZE = 1 << 16
+
+def escape( text: str ) -> str:
+    return text.translate( ESCAPE )
+
+class AtomicWriter:
+    """
+    A buffered writer that only replaces its target once everything has been written.
+
+    Output goes to a temporary file beside the target and is hashed as it goes; commit() then renames it into place,
+    unless the target already holds identical bytes, in which case it is left untouched (mtime and all).
+    """
+    def __init__( self, path: str, encoding: str = 'utf-8', bufferSize: int = BUFFER_SIZE ) -> None:
+        self.path = path
+        self.encoding = encoding
+        directory = os.path.dirname( path ) or '.'
+        os.makedirs( directory, exist_ok=True )
+        self.temp = os.path.join( directory, f".{os.path.basename( path )}.{secrets.token_hex( 4 )}.tmp" )
+        self.file = open( self.temp, 'xb', buffering=bufferSize ) # Not mkstemp, so the output gets the usual umask
+        self.digest = hashlib.blake2b()
+        self.size = 0
+
+    def write( self, text: str ):
+        data = text.encode( self.encoding )
+        self.digest.update( data )
+        self.size += len( data )
+        self.file.write( data )
+
+    def unchanged( self ) -> bool:
+        try:
+            if os.path.getsize( self.path ) != self.size:
+                return False
+            existing = hashlib.blake2b()
+            with open( self.path, 'rb' ) as f:
+                for chunk in iter( lambda: f.read( BUFFER_SIZE ), b'' ):
+                    existing.update( chunk )
+            return existing.digest() == self.digest.digest()
+        except FileNotFoundError:
+            return False
+
+    def commit( self ) -> bool:
+        """Puts the output in place, returning False if it was identical to what was already there"""
+        self.file.close()
+        if self.unchanged():
+            os.remove( self.temp )
+            return False
+        os.replace( self.temp, self.path )
+        return True
+
+    def abort( self ):
+        self.file.close()
+        os.remove( self.temp )
+
+def renderContainer( generator, node: Container ):
+    yield from generator.children( node )
+
+def renderParagraph( generator, node: Paragraph ):
+    yield '<div class="scope">\n'
+    yield from generator.children( node )
+    yield '</div>\n'
+
+def renderTitle( generator, node: Title ):
+    depth = min( max( node.depth, 1 ), 6 )
+    anchor = generator.anchor( node.value )
+    generator.headings.append( ( anchor, node.depth, node.value, node.line ) )
+    yield f'<h{depth} id="{anchor}">{escape( node.value )}</h{depth}>\n'
+
+def renderText( generator, node: Text ):
+    yield f"<p>{escape( node.text )}</p>\n"
+
+def renderNothing( generator, node: Node ):
+    return ()
+
 class Generator:
-    def __init__(self) -> None:
-        pass
\ No newline at end of file
+    """
+    Renders a parsed Document to HTML, streaming it out in small chunks rather than building the page in memory.
+
+    Each node type maps to a function( generator, node ) yielding chunks of HTML; addons that define their own nodes
+    add their renderers to Generator.renderers. Unknown containers just render their children.
+    """
+    renderers = {
+        Document: renderContainer,
+        Paragraph: renderParagraph,
+        Title: renderTitle,
+        Text: renderText,
+        Break: renderNothing
+    }
+
+    def __init__( self, encoding: str = 'utf-8' ) -> None:
+        self.encoding = encoding
+        self.anchor = Anchors() # The same anchors the heading index records, so links into the page resolve
+        self.headings = []      # Every title rendered, as Index.headings() would list them
+
+    def render( self, document: Document, path: str ) -> bool:
+        """Writes 'document' to 'path', returning False if the file already had exactly this content"""
+        writer = AtomicWriter( path, self.encoding )
+        try:
+            for chunk in self.chunks( document ):
+                writer.write( chunk )
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def stream( self, parser: Parser, path: str ) -> bool:
+        """
+        Like render(), but straight from the parser's events, so the page is written as the source is parsed and no
+        document tree is ever built. Memory use stays flat however large the source is.
+        """
+        writer = AtomicWriter( path, self.encoding )
+        try:
+            parser.events( EventWriter( self, writer.write ) )
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def header( self ) -> str:
+        self.anchor = Anchors()
+        self.headings = []
+        return f'<!DOCTYPE html>\n<html>\n<head><meta charset="{self.encoding}"></head>\n<body>\n'
+
+    def footer( self ) -> str:
+        return '</body>\n</html>\n'
+
+    def chunks( self, document: Document ):
+        yield self.header()
+        yield from self.node( document )
+        yield self.footer()
+
+    def node( self, node: Node ):
+        renderer = self.renderers.get( node.__class__ )
+        if renderer is None:
+            renderer = renderContainer if isinstance( node, Container ) else renderNothing
+        return renderer( self, node )
+
+    def children( self, node: Container ):
+        for child in node.children:
+            yield from self.node( child )
+
+class EventWriter(Handler):
+    """Renders parser events as they arrive, writing each chunk with 'write'. Used by Generator.stream()"""
+    def __init__( self, generator: Generator, write ) -> None:
+        self.generator = generator
+        self.write = write
+
+    def startDocument( self ):
+        self.write( self.generator.header() )
+
+    def endDocument( self ):
+        self.write( self.generator.footer() )
+
+    def startScope( self, line: int, scope: int ):
+        self.write( '<div class="scope">\n' )
+
+    def endScope( self, scope: int ):
+        self.write( '</div>\n' )
+
+    def title( self, node: Node ):
+        for chunk in self.generator.node( node ):
+            self.write( chunk )
+
+    text = lineBreak = addon = title
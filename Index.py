@@ -0,0 +1,139 @@
+# MIT License
+# 
+# Copyright (c) 2022 Dr John Vidler
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import re
+import os
+import sqlite3
+from Nodes import Document, Title
+
+INDEX_NAME = ".sdml-index.sqlite"
+
+SLUG_STRIP = re.compile( r'[^\w\s-]' )
+SLUG_SPACE = re.compile( r'[\s_-]+' )
+
+def slugify( text: str ) -> str:
+    """Lowercases 'text' and reduces it to words joined by hyphens, for use as an anchor"""
+    return SLUG_SPACE.sub( '-', SLUG_STRIP.sub( '', text.lower() ) ).strip( '-' ) or 'section'
+
+class Anchors:
+    """Hands out the anchor for each title in a document, numbering repeats so every anchor is unique"""
+    def __init__( self ) -> None:
+        self.seen = {}
+
+    def __call__( self, text: str ) -> str:
+        slug = slugify( text )
+        count = self.seen.get( slug, 0 ) + 1
+        self.seen[slug] = count
+        return slug if count == 1 else f"{slug}-{count}"
+
+def headings( document: Document ) -> list:
+    """Every title in 'document', in order, as ( anchor, depth, title, line ) tuples"""
+    anchor = Anchors()
+    return [ ( anchor( node.value ), node.depth, node.value, node.line ) for node in document.walk() if isinstance( node, Title ) ]
+
+class HeadingIndex:
+    """
+    Every title across the built corpus, kept in SQLite beside the build output so tables of contents and
+    cross-document links can be answered without reparsing anything.
+
+    Only sources that are rebuilt are rewritten, each in one transaction. Lookups by anchor, or by anchor prefix,
+    are range scans over an index, so they stay O(log n) however many documents there are.
+    """
+    def __init__( self, buildPath: str ) -> None:
+        self.path = os.path.join( buildPath, INDEX_NAME )
+        self.db = sqlite3.connect( self.path )
+        self.db.executescript( """
+            CREATE TABLE IF NOT EXISTS headings (
+                source  TEXT NOT NULL,
+                ordinal INTEGER NOT NULL,
+                anchor  TEXT NOT NULL,
+                depth   INTEGER NOT NULL,
+                title   TEXT NOT NULL,
+                line    INTEGER,
+                output  TEXT,
+                PRIMARY KEY ( source, ordinal )
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS headings_anchor ON headings ( anchor );
+            CREATE TABLE IF NOT EXISTS sources (
+                source TEXT PRIMARY KEY
+            ) WITHOUT ROWID;
+        """ )
+
+    def update( self, source: str, output: str, titles: list ):
+        """Replaces everything indexed for 'source' with 'titles', as returned by headings()"""
+        with self.db:
+            self.db.execute( "DELETE FROM headings WHERE source = ?", ( source, ) )
+            self.db.executemany( "INSERT INTO headings VALUES ( ?, ?, ?, ?, ?, ?, ? )",
+                                 ( ( source, ordinal, anchor, depth, title, line, output )
+                                   for ordinal, ( anchor, depth, title, line ) in enumerate( titles ) ) )
+            self.db.execute( "INSERT OR IGNORE INTO sources VALUES ( ? )", ( source, ) )
+
+    def remove( self, sources ):
+        with self.db:
+            for source in sources:
+                self.db.execute( "DELETE FROM headings WHERE source = ?", ( source, ) )
+                self.db.execute( "DELETE FROM sources WHERE source = ?", ( source, ) )
+
+    def sources( self ) -> set:
+        """Every source that has been indexed, even those without any titles"""
+        return { row[0] for row in self.db.execute( "SELECT source FROM sources" ) }
+
+    def find( self, anchor: str ) -> list:
+        """Every title with exactly this anchor, as ( source, output, anchor, depth, title, line ) tuples"""
+        return self.db.execute( "SELECT source, output, anchor, depth, title, line FROM headings WHERE anchor = ? "
+                                "ORDER BY source, ordinal", ( anchor, ) ).fetchall()
+
+    def prefix( self, prefix: str, limit: int = -1 ) -> list:
+        """Every title whose anchor starts with 'prefix', in anchor order"""
+        prefix = slugify( prefix ) if prefix else ''
+        if not prefix:
+            return self.db.execute( "SELECT source, output, anchor, depth, title, line FROM headings "
+                                    "ORDER BY anchor LIMIT ?", ( limit, ) ).fetchall()
+
+        # A range rather than LIKE, which SQLite will only serve from the index under a case-sensitive collation
+        upper = prefix[:-1] + chr( ord( prefix[-1] ) + 1 )
+        return self.db.execute( "SELECT source, output, anchor, depth, title, line FROM headings "
+                                "WHERE anchor >= ? AND anchor < ? ORDER BY anchor LIMIT ?", ( prefix, upper, limit ) ).fetchall()
+
+    def toc( self, source: str ) -> list:
+        """The titles of one source, in document order, as ( anchor, depth, title, line ) tuples"""
+        return self.db.execute( "SELECT anchor, depth, title, line FROM headings WHERE source = ? ORDER BY ordinal",
+                                ( source, ) ).fetchall()
+
+    def resolve( self, text: str, relativeTo: str = None ) -> str:
+        """
+        A link to the title best matching 'text' (an anchor or the title itself), or None if there isn't one. If
+        'relativeTo' is an output path, titles in that document win and the link is made relative to it.
+        """
+        matches = self.find( slugify( text ) )
+        if not matches:
+            return None
+        local = [ match for match in matches if match[1] == relativeTo ]
+        _, output, anchor, *_ = ( local or matches )[0]
+        if relativeTo is None:
+            return f"{output}#{anchor}"
+        if output == relativeTo:
+            return f"#{anchor}"
+        return f"{os.path.relpath( output, os.path.dirname( relativeTo ) )}#{anchor}"
+
+    def close( self ):
+        self.db.close()
@@ -22,11 +22,28 @@
 
 import re
 import os
+import mmap
+from array import array
+from collections import deque
 from DataStructures import SparseList
 from enum import Enum
 from Logging import Log
 
 ENCODING = os.getenv("SDML_ENCODING", 'utf-8' )
+LOOKAHEAD = int( os.getenv("SDML_LOOKAHEAD", 4 ) )
+MAPPED = os.getenv("SDML_MMAP", "FALSE") == "TRUE"
+WORDS = os.getenv("SDML_WORDS", "FALSE") == "TRUE" # One TEXT token per word, rather than per line
+LINE_END = re.compile( rb'\r\n?|\n' ) # The same line ends universal newlines mode splits decoded input on
+
+def asciiCompatible( encoding: str ) -> bool:
+    """Whether 'encoding' stores ASCII as plain ASCII bytes, which mapped lexing relies on to find lines and markup"""
+    sample = bytes( range( 128 ) )
+    try:
+        return sample.decode( encoding ) == sample.decode( 'ascii' )
+    except (LookupError, UnicodeDecodeError):
+        return False
+
+MAPPABLE = asciiCompatible( ENCODING ) # UTF-16 and friends are read decoded, even when mapping is asked for
 
 class TokenType(Enum):
     TEXT = 0
@@ -34,19 +51,40 @@ class TokenType(Enum):
     DIRECTIVE = 2
     ARGUMENT = 3
 
+TOKEN_TYPES = tuple( TokenType ) # Indexed by value, for unpacking compact rows quickly
+
 class Token:
-    scope = None
-    type = None
-    value = None
-    line: int = -1
+    __slots__ = ( 'scope', 'type', '_value', 'line', 'span', 'source' )
 
-    def __init__( self, scope, value, type = TokenType.TEXT, line: int = None ) -> None:
+    def __init__( self, scope, value, type = TokenType.TEXT, line: int = None, span: tuple = None, source = None ) -> None:
         self.scope = scope
         self.type = type
-        self.value = value
+        self._value = value
         self.line = line
+        self.span = span     # (start, end) byte offsets into the source, when lexed from a mapped file
+        self.source = source # The mapped buffer to lazily decode our value from, if we weren't given one
     
+    @property
+    def value( self ):
+        if self._value is None and self.source is not None:
+            start, end = self.span
+            self._value = ' '.join( str( self.source[start:end], ENCODING ).split() ) # A run may be spaced any old way
+        return self._value
+
+    @value.setter
+    def value( self, value ):
+        self._value = value
+
+    @property
+    def column( self ) -> int:
+        """The 1-based byte column this token starts at, if it has a span"""
+        if self.span is None or self.source is None:
+            return None
+        return self.span[0] - self.source.rfind( b'\n', 0, self.span[0] )
+
     def __str__(self) -> str:
+        if self.span:
+            return F"[Token line={self.line}, column={self.column}, span={self.span}, type={self.type}, scope={self.scope}, value={self.value}]"
         return F"[Token line={self.line}, type={self.type}, scope={self.scope}, value={self.value}]"
     
     def isChildOf( self, parent ):
@@ -55,6 +93,152 @@ class Token:
     def isParentOf( self, child ):
         return child.scope == self.scope+1
 
+class TokenStore:
+    """
+    Compact storage for a whole token stream.
+
+    Rows are kept as parallel typed arrays of type, scope, line and span, with each value held as an offset into a
+    shared pool of interned strings, so a stored token costs a handful of bytes rather than a full object. Indexing
+    the store hands back a Token for that row, and a TokenReader replays the store to a Parser.
+
+    Tokens lexed from a mapped source keep their spans and are still decoded lazily, from the lexer's map, so keep
+    that lexer open for as long as the store is read.
+    """
+    def __init__( self ) -> None:
+        self.types = array( 'b' )
+        self.scopes = array( 'i' )
+        self.lines = array( 'i' )
+        self.values = array( 'i' )
+        self.starts = array( 'q' )
+        self.ends = array( 'q' )
+        self.source = None
+        self.pool = []
+        self.poolIndex = {}
+
+    def intern( self, value ) -> int:
+        if value is None:
+            return -1
+        offset = self.poolIndex.get( value )
+        if offset is None:
+            offset = self.poolIndex[value] = len( self.pool )
+            self.pool.append( value )
+        return offset
+
+    def append( self, token: Token ):
+        self.types.append( token.type.value )
+        self.scopes.append( token.scope )
+        self.lines.append( token.line if token.line is not None else -1 )
+        self.values.append( self.intern( token._value ) )
+        if token.span is None:
+            self.starts.append( -1 )
+            self.ends.append( -1 )
+        else:
+            self.starts.append( token.span[0] )
+            self.ends.append( token.span[1] )
+            self.source = token.source
+
+    def extend( self, tokens ):
+        for token in tokens:
+            self.append( token )
+
+    def record( self, lexer ):
+        """
+        Stores every token 'lexer' hands out from now on. Record while parsing, so the store holds exactly what the
+        parser saw, including everything the addons it bound added.
+        """
+        nextToken = lexer.nextToken
+        last = None
+        def recorded():
+            nonlocal last
+            token = nextToken()
+            if token is not None and token is not last: # The parser may push back the token it just took
+                self.append( token )
+                last = token
+            return token
+        lexer.nextToken = recorded
+
+    def __len__( self ) -> int:
+        return len( self.types )
+
+    def __getitem__( self, row: int ) -> Token:
+        value = self.values[row]
+        start = self.starts[row]
+        return Token( self.scopes[row], self.pool[value] if value >= 0 else None, TOKEN_TYPES[self.types[row]], self.lines[row],
+                      ( start, self.ends[row] ) if start >= 0 else None, self.source if start >= 0 else None )
+
+    def __iter__( self ):
+        for row in range( len(self.types) ):
+            yield self[row]
+
+class TokenReader:
+    """
+    Replays a TokenStore with the same nextToken()/peek() interface as a Lexer, so a Parser can read from it.
+
+    The stored tokens already hold whatever the recorded parse's addons lexed, so an addon bound again here only
+    registers its directive handlers; its lexer stages are ignored.
+    """
+    def __init__( self, store: TokenStore, lookahead: int = LOOKAHEAD ) -> None:
+        self.store = store
+        self.row = 0
+        self.lookahead = lookahead
+        self.buffer = deque()
+        self.words = WORDS
+        self.scope = 0
+        self.inputLine = 0
+
+    def setStage( self, index: int, func ):
+        pass
+
+    def clearStage( self, index: int, func ):
+        pass
+
+    def close( self ):
+        pass
+
+    def nextToken( self ) -> Token:
+        if self.buffer:
+            return self.buffer.popleft()
+        if self.row < len( self.store ):
+            self.row += 1
+            return self.store[self.row - 1]
+        return None
+
+    def peek( self, k: int = 1 ) -> Token:
+        """Returns the k-th upcoming token without consuming it, or None if the store runs out first"""
+        if k < 1 or k > self.lookahead:
+            raise ValueError( f"Lexer lookahead is limited to 1..{self.lookahead} tokens, but {k} were requested" )
+        store = self.store
+        while len(self.buffer) < k and self.row < len( store ):
+            self.buffer.append( store[self.row] )
+            self.row += 1
+        return self.buffer[k-1] if len(self.buffer) >= k else None
+
+SCOPE_PATTERN = re.compile( r'^(\s+)' )
+WORD_PATTERN = re.compile( rb'\S+' )
+UNMAPPABLE_PATTERN = re.compile( rb'[\x1c-\x1f\x80-\xff]' ) # Bytes that str patterns might treat differently
+TRAILING_SPACE = frozenset( b' \t\r\x0b\x0c' )
+
+def prefixStage( pattern: str ):
+    """
+    Turns a handler( lexer, match ) into a lexer stage that fires only when a line starts with 'pattern'.
+
+    The consumed prefix is removed from the line before it is passed on. Prefix stages directly after the scope
+    stage are fused by the Lexer into one precompiled pattern, so their patterns must only use named groups.
+    """
+    compiled = re.compile( pattern )
+    def wrap( handler ):
+        def stage( lexer, line: str ):
+            match = compiled.match( line )
+            if match:
+                handler( lexer, match )
+                line = line[ match.end(): ].lstrip()
+            return line
+        stage.__name__ = handler.__name__
+        stage.prefix = pattern
+        stage.handler = handler
+        return stage
+    return wrap
+
 def lex_rStrip( lexer, line: str ):
     return line.rstrip() # Drop the trailing \n, plus any additional whitespace
 
@@ -64,40 +248,114 @@ def lex_blankBreaks( lexer, line: str ):
     return line
 
 def lex_handleScope( lexer, line: str ):
-    lexer.scope = 0
-    scopePrefix = re.search( '^(\s+)', line )
-    if scopePrefix != None:
-        if lexer.scopeStep == 0:
-            Log.info( F"First scoped block, using {len(scopePrefix.group(1))} spaces as our scope step size" )
-            lexer.scopeStep = len(scopePrefix.group(1))
-        lexer.scope = int(len(scopePrefix.group(1)) / lexer.scopeStep)
+    scopePrefix = SCOPE_PATTERN.match( line )
+    lexer.setScope( len(scopePrefix.group(1)) if scopePrefix else 0 )
     return line
 
-def lex_handleDirective( lexer, line: str ):
-    directiveMatch = re.search( '^\W*\.\.([^:]+):', line )
-    if directiveMatch:
-        lexer.buffer.append( Token( lexer.scope, directiveMatch.group(1), type = TokenType.DIRECTIVE, line = lexer.inputLine ) )
-
-        # Consume this from the input
-        line = line[ len(directiveMatch.group(0)): ].lstrip()
-    return line
+@prefixStage( r'\W*\.\.(?P<directive>[^:]+):' )
+def lex_handleDirective( lexer, match ):
+    lexer.buffer.append( Token( lexer.scope, lexer.matchText( match, 'directive' ), type = TokenType.DIRECTIVE, line = lexer.inputLine ) )
 
 def lex_handleText( lexer, line: str ):
-    for word in line.split():
-        lexer.buffer.append( Token( lexer.scope, word, type = TokenType.TEXT, line = lexer.inputLine ) )    
+    if lexer.words:
+        scope, text, inputLine = lexer.scope, TokenType.TEXT, lexer.inputLine
+        lexer.buffer.extend( [ Token( scope, word, text, inputLine ) for word in line.split() ] )
+    else:
+        run = ' '.join( line.split() ) # The whole line as one token, spaced exactly as joining its words would be
+        if run:
+            lexer.buffer.append( Token( lexer.scope, run, TokenType.TEXT, lexer.inputLine ) )
     return line
 
+class StageChain:
+    """
+    The compiled form of a stage table.
+
+    Empty slots are dropped, and if the table starts with the standard strip/break/scope stages then those, plus any
+    prefix stages that directly follow them, are fused into a single pattern match per line. Anything after that
+    falls through to the remaining stages in order.
+    """
+    __slots__ = ( 'pipeline', 'prefixes', 'remainder', 'pattern', 'bytesPattern', 'bytesPrefixes' )
+
+    def __init__( self, pipeline: tuple ) -> None:
+        self.pipeline = pipeline
+        self.prefixes = ()
+        self.remainder = pipeline
+        self.pattern = None
+        self.bytesPattern = None
+        self.bytesPrefixes = ()
+
+        if pipeline[:3] != (lex_rStrip, lex_blankBreaks, lex_handleScope):
+            return
+
+        prefixes = []
+        for stage in pipeline[3:]:
+            if not hasattr( stage, 'prefix' ):
+                break
+            prefixes.append( stage )
+
+        alternatives = '|'.join( f"(?P<_stage{i}>{stage.prefix})" for i, stage in enumerate(prefixes) )
+        self.pattern = re.compile( rf"(?P<_indent>\s*)(?:{alternatives})?" )
+        self.prefixes = tuple( prefixes )
+        self.remainder = pipeline[ 3 + len(prefixes): ]
+
+        # Mapped input can be scanned in place as long as nothing but plain text handling follows the prefixes
+        if self.remainder == (lex_handleText,):
+            self.bytesPattern = re.compile( self.pattern.pattern.encode() )
+            self.bytesPrefixes = tuple( re.compile( stage.prefix.encode() ) for stage in prefixes )
+
 class Lexer:
+    chains = {}     # Every StageChain compiled so far, keyed by its pipeline
+    profiler = None # If set, every stage is wrapped for timing as it is set
     input = None
+    source = None
+    opened = False
+    words = WORDS
     inputLine = 0
     scopeStep = 0
     scope = 0
-    buffer = []
-    stages = SparseList()
+    buffer = None
+    stages = None
+    lexLine = None
+    lexSpan = None
+    lookahead = LOOKAHEAD
+
+    def __init__( self, file, lookahead: int = LOOKAHEAD, mapped: bool = MAPPED, words: bool = WORDS ) -> None:
+        """
+        'file' is either a path to open, or an already open text stream to lex from (which is never mapped).
 
-    def __init__( self, file ) -> None:
-        self.input = open( file, 'r', encoding=ENCODING )
+        Text is lexed as one TEXT token per line, unless 'words' is set (or an addon sets lexer.words because it wants
+        to see individual words), in which case each word is its own token.
+        """
+        self.lookahead = lookahead
+        self.reset( file, mapped, words )
+
+    def reset( self, file, mapped: bool = MAPPED, words: bool = WORDS ):
+        """Readies this lexer for a new input, exactly as if it had just been created, so instances can be reused"""
+        self.close()
+        self.words = words
+        self.opened = False
+        vars( self ).pop( 'fill', None ) # Back to reading decoded lines, unless we map this one too
+        if not isinstance( file, (str, os.PathLike) ):
+            self.input = file
+        else:
+            self.opened = True
+            if mapped and MAPPABLE:
+                self.input = open( file, 'rb' )
+                try:
+                    self.source = mmap.mmap( self.input.fileno(), 0, access=mmap.ACCESS_READ )
+                    self.offset = 0
+                    self.returns = self.source.find( b'\r' ) >= 0 # Only pay for LINE_END when there's a '\r' to find
+                    self.fill = self.fillMapped
+                except ValueError: # Empty files can't be mapped, so just read those normally
+                    self.input.close()
+                    self.input = None
+            if self.input is None:
+                self.input = open( file, 'r', encoding=ENCODING )
         self.inputLine = 0
+        self.scope = 0
+        self.scopeStep = 0
+        self.buffer = deque()
+        self.stages = SparseList()
 
         self.setStage( 0,   lex_rStrip )           # Clear any RHS whitespace, for a tiny speedup
         self.setStage( 10,  lex_blankBreaks )      # Handle blank lines
@@ -105,32 +363,193 @@ class Lexer:
         self.setStage( 30,  lex_handleDirective )  # Search for a directive preamble, and short-form content...
         self.setStage( 100, lex_handleText )       # At this point, just assume the rest is text, and start emitting values
 
+    def close( self ):
+        """
+        Releases anything this lexer opened itself. Streams handed to it are left to their owner. Mapped tokens decode
+        lazily, so read the value of any token you still hold before closing.
+        """
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        if self.input is not None and self.opened:
+            self.input.close()
+        self.input = None
+
     def setStage( self, index: int, func ):
         if self.stages[index]:
             Log.warn( f"Lexer stage {index} was already in use, but has been overwritten!" )
+        if self.profiler:
+            func = self.profiler.stage( index, func )
         self.stages[index] = func
+        self.compileStages()
     
     def clearStage( self, index:int, func ):
-        if self.stages[index] and self.stages[index] != func:
+        current = self.stages[index]
+        if current and getattr( current, 'wrapped', current ) != func:
             Log.warn( f"Lexer stage {index} was in use, but not by the function supplied! Refusing to remove." )
             return
         self.stages[index] = None
+        self.compileStages()
 
-    def nextToken(self) -> Token:
-        
-        # Attempt to fill the buffer
-        while self.input.readable() and len(self.buffer) == 0:
+    def setScope( self, indent: int ):
+        self.scope = 0
+        if indent > 0:
+            if self.scopeStep == 0:
+                Log.info( "First scoped block, using %d spaces as our scope step size", indent )
+                self.scopeStep = indent
+            self.scope = int(indent / self.scopeStep)
+
+    def compileStages( self ):
+        """
+        Rebuilds the per-line dispatch from the stage table.
+
+        Compiled chains are cached by their stages, so every Lexer with the same set of addons bound shares one.
+        """
+        pipeline = tuple( stage for stage in self.stages if stage )
+        chain = Lexer.chains.get( pipeline )
+        if chain is None:
+            chain = Lexer.chains[pipeline] = StageChain( pipeline )
+
+        self.pipeline = chain.pipeline
+        self.fusedPattern = chain.pattern
+        self.fusedPrefixes = chain.prefixes
+        self.fusedRemainder = chain.remainder
+        self.fusedBytesPattern = chain.bytesPattern
+        self.bytesPrefixes = chain.bytesPrefixes
+        self.lexLine = self.lexFused if chain.pattern else self.lexPipeline
+        self.lexSpan = self.lexMapped if chain.bytesPattern else self.lexDecoded
+
+    def lexPipeline( self, line: str ):
+        for stage in self.pipeline:
+            line = stage( self, line )
+            if line is None: # The stage has dealt with the whole line itself
+                return
+
+    def lexFused( self, line: str ):
+        prefixes, remainder = self.fusedPrefixes, self.fusedRemainder # A handler may rebind the stages under us
+        line = line.rstrip()
+        if line:
+            match = self.fusedPattern.match( line )
+            self.setScope( match.end('_indent') )
+
+            hit = match.lastgroup
+            if hit != '_indent':
+                index = int( hit[6:] )
+                prefixes[index].handler( self, match )
+                line = line[ match.end(): ].lstrip()
+                for stage in prefixes[index+1:]:
+                    line = stage( self, line )
+        else:
+            self.buffer.append( Token( self.scope, None, type=TokenType.BREAK, line=self.inputLine ) )
+            self.scope = 0
+            for stage in prefixes:
+                line = stage( self, line )
+
+        for stage in remainder:
+            line = stage( self, line )
+            if line is None: # As in lexPipeline, the stage has dealt with the whole line itself
+                return
+
+    def lexDecoded( self, start: int, end: int ):
+        self.lexLine( str( self.source[start:end], ENCODING ) )
+
+    def lexMapped( self, start: int, end: int ):
+        source = self.source
+
+        # Bytes patterns only know ASCII whitespace and digits, so lines that aren't plain ASCII are decoded instead
+        if UNMAPPABLE_PATTERN.search( source, start, end ):
+            self.lexDecoded( start, end )
+            return
+
+        # Strip the line first, just as lexFused does, so prefixes anchored at the end of the line match the same
+        while end > start and source[end-1] in TRAILING_SPACE:
+            end -= 1
+
+        match = self.fusedBytesPattern.match( source, start, end )
+        indent = match.end('_indent')
+        if indent == end:
+            self.buffer.append( Token( self.scope, None, type=TokenType.BREAK, line=self.inputLine ) )
+            self.scope = 0
+            return
+
+        self.setScope( indent - start )
+        position = indent
+        hit = match.lastgroup
+        if hit != '_indent':
+            index = int( hit[6:] )
+            prefixes, bytesPrefixes = self.fusedPrefixes, self.bytesPrefixes # A handler may rebind the stages under us
+            prefixes[index].handler( self, match )
+            position = match.end()
+            for stage, pattern in zip( prefixes[index+1:], bytesPrefixes[index+1:] ):
+                match = pattern.match( source, position, end )
+                if match:
+                    stage.handler( self, match )
+                    position = match.end()
+
+        if self.words:
+            scope, text, inputLine = self.scope, TokenType.TEXT, self.inputLine
+            self.buffer.extend( [ Token( scope, None, text, inputLine, word.span(), source ) for word in WORD_PATTERN.finditer( source, position, end ) ] )
+            return
+
+        first = WORD_PATTERN.search( source, position, end )
+        if first:
+            self.buffer.append( Token( self.scope, None, TokenType.TEXT, self.inputLine, ( first.start(), end ), source ) )
+
+    def fill( self, count: int ) -> bool:
+        """Lexes more lines until at least 'count' tokens are buffered, or the input runs out"""
+        buffer = self.buffer
+        while len(buffer) < count:
             line = self.input.readline()
-            self.inputLine += 1
             if not line:
-                break
-            
-            for stage in self.stages:
-                if stage:
-                    line = stage( self, line )
+                return False
+            self.inputLine += 1
+            self.lexLine( line )
+        return True
+
+    def fillMapped( self, count: int ) -> bool:
+        """As fill(), but walks the mapped source by offset instead of reading decoded lines"""
+        buffer, source = self.buffer, self.source
+        while len(buffer) < count:
+            start = self.offset
+            if start >= len(source):
+                return False
+            if self.returns:
+                match = LINE_END.search( source, start )
+                end, self.offset = match.span() if match else ( len(source), len(source) )
+            else:
+                end = source.find( b'\n', start )
+                if end < 0:
+                    end = len(source)
+                self.offset = end + 1
+            self.inputLine += 1
+            self.lexSpan( start, end )
+        return True
+
+    def matchText( self, match, group ) -> str:
+        """Returns a named group from a stage match as a string, whether we matched decoded text or mapped bytes"""
+        value = match.group( group )
+        if isinstance( value, bytes ):
+            return str( value, ENCODING )
+        return value
+
+    def nextToken(self) -> Token:
+        if self.buffer or self.fill( 1 ):
+            return self.buffer.popleft()
+        return None
+
+    def peek( self, k: int = 1 ) -> Token:
+        """Returns the k-th upcoming token without consuming it, or None if the stream ends first"""
+        if k < 1 or k > self.lookahead:
+            raise ValueError( f"Lexer lookahead is limited to 1..{self.lookahead} tokens, but {k} were requested" )
+        if len(self.buffer) >= k or self.fill( k ):
+            return self.buffer[k-1]
+        return None
+
+    def __iter__( self ):
+        return self
 
-        # Just dequeue if we already have buffered tokens
-        if len(self.buffer) > 0:
-            return self.buffer.pop(0)
-        
-        return None
\ No newline at end of file
+    def __next__( self ) -> Token:
+        token = self.nextToken()
+        if token is None:
+            raise StopIteration
+        return token
@@ -20,7 +20,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import sys
+import atexit
+import threading
+import os
 from os import getenv
+from queue import SimpleQueue
 from enum import IntEnum
 
 colour = getenv( "SDML_COLOR_LOGS", "TRUE" ) == "TRUE"
@@ -36,54 +41,158 @@ class LogLevel(IntEnum):
     WARNING = 1
     ERROR = 0
 
-class Log:
+def parseLevel( value: str ) -> LogLevel:
+    """Accepts either a level name ('debug', 'WARNING', ...) or its number, raising ValueError for anything else"""
+    if value.isdigit():
+        return LogLevel( int(value) )
+    try:
+        return LogLevel[ value.upper() ]
+    except KeyError:
+        names = ', '.join( level.name.lower() for level in LogLevel )
+        raise ValueError( f"unknown log level '{value}', expected one of {names}" ) from None
+
+class LogSink:
+    """Collects log lines and writes them out in batches, rather than one write (and flush) per line"""
+    def __init__( self, stream = None, batch: int = 64 ) -> None:
+        self.stream = stream
+        self.batch = batch
+        self.lines = []
+        self.lock = threading.Lock()
+
+    def write( self, line: str, urgent: bool = False ):
+        with self.lock:
+            self.lines.append( line )
+            full = len(self.lines) >= self.batch
+        if urgent or full:
+            self.flush()
+
+    def flush( self ):
+        with self.lock:
+            lines, self.lines = self.lines, []
+            if lines:
+                self.emit( lines )
+
+    def afterFork( self ):
+        """Called in a forked child. The parent flushed before forking, so nothing we hold is ours to write."""
+        self.lines = []
+        self.lock = threading.Lock()
+
+    def emit( self, lines: list ):
+        stream = self.stream or sys.stdout
+        stream.write( '\n'.join( lines ) + '\n' )
+        stream.flush()
+
+class BackgroundSink(LogSink):
+    """A LogSink that hands lines to a writer thread, so the caller never waits on the terminal"""
+    def __init__( self, stream = None, batch: int = 64 ) -> None:
+        super().__init__( stream, batch )
+        self.start()
+
+    def start( self ):
+        self.queue = SimpleQueue()
+        self.thread = threading.Thread( target=self.run, name="sdml-log", daemon=True )
+        self.thread.start()
+
+    def afterFork( self ):
+        """Threads don't survive a fork, so the child needs its own writer (and a queue the old one never touched)"""
+        super().afterFork()
+        self.start()
+
+    def write( self, line: str, urgent: bool = False ):
+        self.queue.put( line )
+        if urgent:
+            self.flush()
+
+    def flush( self ):
+        done = threading.Event()
+        self.queue.put( done )
+        done.wait()
+
+    def run( self ):
+        while True:
+            lines = []
+            item = self.queue.get()
+            while True:
+                if isinstance( item, threading.Event ):
+                    if lines:
+                        self.emit( lines )
+                        lines = []
+                    item.set()
+                else:
+                    lines.append( item )
+                if len(lines) >= self.batch or self.queue.empty():
+                    break
+                item = self.queue.get()
+            if lines:
+                self.emit( lines )
+
+def style( colours, tag: str ) -> tuple:
+    """The (prefix, suffix) wrapped around every line at one level, worked out once rather than per call"""
+    if colour:
+        return ( f"{colours}[{tag}]  ", Style.RESET_ALL )
+    return ( f"[{tag}]  ", "" )
+
+def discard( text, *args ):
+    pass
+
+class LogConfig(type):
+    """Re-binds Log's methods whenever its level changes, so disabled levels become a call to discard()"""
+    def __setattr__( cls, name, value ):
+        super().__setattr__( name, value )
+        if name == 'level':
+            cls.configure()
+
+class Log(metaclass=LogConfig):
+    """
+    Levelled logging.
+
+    Messages take %-style arguments, or may be a callable returning the message, and are only formatted if their
+    level is enabled. Disabled levels are swapped for a no-op whenever Log.level is set, so a disabled
+    Log.debug( "...%s", value ) costs no more than an empty call. Enabled lines go to Log.sink, which batches them up.
+    """
     prefix = False
-    level = LogLevel.WARNING
+    sink = BackgroundSink() if getenv( "SDML_LOG_THREAD", "FALSE" ) == "TRUE" else LogSink()
 
-    @staticmethod
-    def __fmtLogStr( type, text ) -> str:
-        return f"[{type}]  {text}"
-    
-    @staticmethod
-    def __styleLogStr( style, type, text ) -> str:
-        return f"{style}{Log.__fmtLogStr( type, text )}{Style.RESET_ALL}"
+    styles = {
+        LogLevel.DEBUG:   style( Fore.CYAN if colour else None, '  ' ),
+        LogLevel.INFO:    style( Fore.WHITE if colour else None, 'II' ),
+        LogLevel.WARNING: style( Style.BRIGHT + Fore.YELLOW if colour else None, 'WW' ),
+        LogLevel.ERROR:   style( Style.BRIGHT + Fore.RED if colour else None, 'EE' )
+    }
+    methods = { LogLevel.DEBUG: 'debug', LogLevel.INFO: 'info', LogLevel.WARNING: 'warn', LogLevel.ERROR: 'error' }
 
-    @staticmethod
-    def debug( text ):
-        if Log.level < LogLevel.DEBUG:
-            return
-        
-        if( colour ):
-            print( Log.__styleLogStr( Fore.CYAN, '  ', text ) )
-        else:
-            print( Log.__fmtLogStr( '  ', text ) )
+    @classmethod
+    def configure( cls ):
+        for level, name in cls.methods.items():
+            setattr( cls, name, staticmethod( cls.writer( level ) if cls.level >= level else discard ) )
 
-    @staticmethod
-    def info( text ):
-        if Log.level < LogLevel.INFO:
-            return
-        
-        if( colour ):
-            print( Log.__styleLogStr( Fore.WHITE, 'II', text ) )
-        else:
-            print( Log.__fmtLogStr( 'II', text ) )
+    @classmethod
+    def writer( cls, level: LogLevel ):
+        prefix, suffix = cls.styles[level]
+        urgent = level <= LogLevel.WARNING
+        def write( text, *args ):
+            if callable( text ):
+                text = text()
+            elif args:
+                text = text % args
+            Log.sink.write( f"{prefix}{text}{suffix}", urgent )
+        return write
 
     @staticmethod
-    def warn( text ):
-        if Log.level < LogLevel.WARNING:
-            return
-        
-        if( colour ):
-            print( Log.__styleLogStr( Style.BRIGHT + Fore.YELLOW, 'WW', text ) )
-        else:
-            print( Log.__fmtLogStr( 'WW', text ) )
+    def enabled( level: LogLevel ) -> bool:
+        return Log.level >= level
 
     @staticmethod
-    def error( text ):
-        if Log.level < LogLevel.ERROR:
-            return
-        
-        if( colour ):
-            print( Log.__styleLogStr( Style.BRIGHT + Fore.RED, 'EE', text ) )
-        else:
-            print( Log.__fmtLogStr( 'EE', text ) )
\ No newline at end of file
+    def flush():
+        Log.sink.flush()
+
+try:
+    Log.level = parseLevel( getenv( "SDML_LOG_LEVEL", "WARNING" ) )
+except ValueError as e:
+    Log.level = LogLevel.WARNING
+    Log.warn( f"Ignoring SDML_LOG_LEVEL: {e}" )
+
+# Workers are forked, so make sure they neither repeat the parent's buffered lines nor wait on its writer thread
+atexit.register( Log.flush )
+if hasattr( os, 'register_at_fork' ):
+    os.register_at_fork( before=Log.flush, after_in_child=lambda: Log.sink.afterFork() )
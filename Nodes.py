@@ -0,0 +1,107 @@
+# MIT License
+# 
+# Copyright (c) 2022 Dr John Vidler
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+def rebuild( cls, values: tuple ):
+    node = cls.__new__( cls )
+    for name, value in zip( cls.fields, values ):
+        setattr( node, name, value )
+    return node
+
+class Node:
+    """
+    Base of every node in a parsed document.
+
+    Nodes only have slots, so a tree costs little more than its text, and they pickle as just their class and a
+    tuple of field values. Subclasses (addons included) add their own slots and are picked up automatically.
+    """
+    __slots__ = ( 'line', )
+    fields = ( 'line', )
+
+    def __init_subclass__( cls, **kwargs ):
+        super().__init_subclass__( **kwargs )
+        cls.fields = tuple( name for klass in reversed( cls.__mro__ ) for name in getattr( klass, '__slots__', () ) )
+
+    def __init__( self, line: int = None ) -> None:
+        self.line = line
+
+    def __reduce__( self ):
+        return ( rebuild, ( self.__class__, tuple( getattr( self, name ) for name in self.fields ) ) )
+
+    def __repr__( self ) -> str:
+        values = ', '.join( f"{name}={getattr( self, name )!r}" for name in self.fields if name != 'children' )
+        return f"{self.__class__.__name__}({values})"
+
+class Container(Node):
+    __slots__ = ( 'children', )
+
+    def __init__( self, line: int = None, children: list = None ) -> None:
+        super().__init__( line )
+        self.children = children if children is not None else []
+
+    def walk( self ):
+        """Yields every node below this one, depth first"""
+        for child in self.children:
+            yield child
+            if isinstance( child, Container ):
+                yield from child.walk()
+
+class Document(Container):
+    __slots__ = ()
+
+class Paragraph(Container):
+    """One level of scope deeper than its parent"""
+    __slots__ = ( 'scope', )
+
+    def __init__( self, line: int = None, scope: int = 0, children: list = None ) -> None:
+        super().__init__( line, children )
+        self.scope = scope
+
+class Title(Node):
+    __slots__ = ( 'text', 'args' )
+
+    def __init__( self, line: int = None, text: str = "", args: dict = None ) -> None:
+        super().__init__( line )
+        self.text = text
+        self.args = args if args is not None else {}
+
+    @property
+    def depth( self ) -> int:
+        try:
+            return int( self.args.get( 'depth', 1 ) )
+        except ValueError:
+            return 1
+
+    @property
+    def value( self ) -> str:
+        """The full title, whether it came from a 'value' argument, the directive text, or both"""
+        return ' '.join( part for part in (self.args.get( 'value' ), self.text) if part )
+
+class Text(Node):
+    """A run of words, already joined with single spaces"""
+    __slots__ = ( 'text', )
+
+    def __init__( self, line: int = None, text: str = "" ) -> None:
+        super().__init__( line )
+        self.text = text
+
+class Break(Node):
+    __slots__ = ()
@@ -0,0 +1,127 @@
+# MIT License
+# 
+# Copyright (c) 2022 Dr John Vidler
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import time
+
+class Profiler:
+    """
+    Opt-in timing of lexer stages, parser directives and whole files.
+
+    Nothing here is on the hot path unless a Profiler is installed as Lexer.profiler/Parser.profiler: stages are then
+    wrapped as they are set (which also stops them being fused, so each is timed on its own) and directives are
+    timed as they are dispatched. Counters are kept as name -> [calls, seconds], and every file and directive is
+    also kept as a span for Chrome's trace viewer.
+    """
+    def __init__( self ) -> None:
+        self.counters = {}
+        self.files = []  # [source, seconds, tokens]
+        self.events = [] # Chrome trace 'complete' events
+        self.wrappers = {} # (index, stage) -> its timed wrapper
+
+    def add( self, name: str, seconds: float, calls: int = 1 ):
+        counter = self.counters.get( name )
+        if counter is None:
+            counter = self.counters[name] = [0, 0.0]
+        counter[0] += calls
+        counter[1] += seconds
+
+    def span( self, name: str, category: str, began: float, seconds: float ):
+        self.events.append( { 'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                              'ts': began * 1e6, 'dur': seconds * 1e6 } )
+
+    def stage( self, index: int, func ):
+        """
+        Wraps a lexer stage so that every call is counted. Each stage is only wrapped once per slot, so every lexer
+        shares the same wrappers and Lexer.chains doesn't gain a new entry for every file.
+        """
+        timed = self.wrappers.get( (index, func) )
+        if timed is None:
+            timed = self.wrappers[(index, func)] = self.wrap( index, func )
+        return timed
+
+    def wrap( self, index: int, func ):
+        name = f"stage {index:>3} {func.__name__}"
+        def timed( lexer, line ):
+            began = time.perf_counter()
+            line = func( lexer, line )
+            self.add( name, time.perf_counter() - began )
+            return line
+        timed.__name__ = func.__name__
+        timed.wrapped = func
+        return timed
+
+    def directive( self, name: str, handler ):
+        began = time.perf_counter()
+        try:
+            return handler()
+        finally:
+            seconds = time.perf_counter() - began
+            self.add( f"directive {name}", seconds )
+            self.span( name, 'directive', began, seconds )
+
+    def countTokens( self, lexer ) -> list:
+        """Counts every token handed out by 'lexer', into the returned one-item list"""
+        count = [0]
+        nextToken = lexer.nextToken
+        def counted():
+            token = nextToken()
+            if token:
+                count[0] += 1
+            return token
+        lexer.nextToken = counted
+        return count
+
+    def file( self, source: str, began: float, seconds: float, tokens: int ):
+        self.files.append( [source, seconds, tokens] )
+        self.span( source, 'file', began, seconds )
+
+    def snapshot( self ) -> dict:
+        """Everything recorded so far, then clears it, so a worker can hand back just what one file cost"""
+        data = { 'counters': self.counters, 'files': self.files, 'events': self.events }
+        self.counters, self.files, self.events = {}, [], []
+        return data
+
+    def merge( self, data: dict ):
+        for name, (calls, seconds) in data['counters'].items():
+            self.add( name, seconds, calls )
+        self.files.extend( data['files'] )
+        self.events.extend( data['events'] )
+
+    def table( self ) -> str:
+        lines = [ f"{'':40} {'calls':>10} {'total ms':>12} {'mean us':>10}" ]
+        for name, (calls, seconds) in sorted( self.counters.items(), key=lambda item: -item[1][1] ):
+            lines.append( f"{name:40} {calls:10} {seconds * 1e3:12.2f} {seconds / calls * 1e6:10.2f}" )
+        lines.append( "" )
+        lines.append( f"{'file':40} {'tokens':>10} {'total ms':>12} {'tokens/s':>10}" )
+        for source, seconds, tokens in sorted( self.files, key=lambda item: -item[1] ):
+            lines.append( f"{source:40} {tokens:10} {seconds * 1e3:12.2f} {tokens / seconds if seconds else 0:10.0f}" )
+        return '\n'.join( lines )
+
+    def json( self ) -> dict:
+        return {
+            'counters': { name: { 'calls': calls, 'seconds': seconds } for name, (calls, seconds) in self.counters.items() },
+            'files': [ { 'source': source, 'seconds': seconds, 'tokens': tokens } for source, seconds, tokens in self.files ]
+        }
+
+    def trace( self ) -> dict:
+        return { 'traceEvents': self.events, 'displayTimeUnit': 'ms' }
@@ -21,14 +21,15 @@
 # SOFTWARE.
 
 import os
-from Logging import Log, LogLevel
-from importlib import import_module
+from Logging import Log
 from enum import auto
 from Lexer import Lexer, TokenType, Token
+from Nodes import Document, Paragraph, Title, Text, Break
+from Addons import registry
 
-Log.level = LogLevel.DEBUG
 
 SCRIPT_PATH = os.path.realpath( __file__ )
+VERSION = "0.3.1"
 
 class Directive(auto):
     USE = "use"
@@ -37,15 +38,42 @@ class Directive(auto):
     FIGURE = "figure"
 
 class Parser:
-    libraries = {}
+    profiler = None # If set, every directive handled is timed
+    libraries = None
     lexer = None;
     nextToken = None;
 
-    def __init__(self, lexer: Lexer) -> None:
+    def __init__(self, lexer: Lexer, libraries = ()) -> None:
         Log.debug( "Creating a new Parser" )
+        self.reset( lexer, libraries )
+
+    def reset( self, lexer: Lexer, libraries = () ):
+        """
+        Readies this parser for a new document from 'lexer', as if it had just been created. The lexer should be new
+        or reset too, since whatever the last document bound to its stages is not unbound here.
+        """
+        self.libraries = {}
+        self.used = set() # Every addon this document has pulled in, even if later unused
         self.lexer = lexer
+
+        # Directive name -> handler, returning a node for the document (or None). Addons may add their own on bind.
+        self.directives = {
+            Directive.USE: self.parseUse,
+            Directive.UNUSE: self.parseUnUse,
+            Directive.TITLE: self.parseTitle
+        }
+
+        # Anything we start with has to be bound before the first token is lexed
+        for library in libraries:
+            self.useLibrary( library )
         self.nextToken = lexer.nextToken()
     
+    def peek( self, k: int = 1 ) -> Token:
+        """Looks k tokens past nextToken, within the lexer's lookahead limit"""
+        if k == 0:
+            return self.nextToken
+        return self.lexer.peek( k )
+
     def acceptToken( self, type: TokenType, value = None ):
         thisToken = self.nextToken
 
@@ -67,15 +95,22 @@ class Parser:
             raise Exception(f"Unexpected token. Wanted {type}/{value}, read {self.nextToken}")
         raise Exception(f"Reached the end of the token stream, but expected {type}/{value}")
     
+    def acceptWord( self ) -> str:
+        """Accepts a single word of text, leaving the rest of its run (if any) as the next token"""
+        token = self.nextToken
+        word, *rest = str( self.acceptToken( TokenType.TEXT ).value ).split( None, 1 )
+        if rest:
+            if self.nextToken is not None:
+                self.lexer.buffer.appendleft( self.nextToken )
+            self.nextToken = Token( token.scope, rest[0], TokenType.TEXT, token.line )
+        return word
+
     def parseDirective( self ):
-        if self.nextToken.value == Directive.USE:
-            return self.parseUse()
-        
-        if self.nextToken.value == Directive.UNUSE:
-            return self.parseUnUse()
-        
-        if self.nextToken.value == Directive.TITLE:
-            return self.parseTitle()
+        handler = self.directives.get( self.nextToken.value )
+        if handler:
+            if self.profiler:
+                return self.profiler.directive( self.nextToken.value, handler )
+            return handler()
 
         if self.nextToken.value == Directive.FIGURE:
             raise Exception( "Unimplemented directive: FIGURE" )
@@ -84,14 +119,16 @@ class Parser:
 
     def parseUse( self ):
         self.acceptToken( TokenType.DIRECTIVE, Directive.USE )
-        library = self.acceptToken( TokenType.TEXT ).value
-        addon = import_module( f"addons.{library}" )
-        self.libraries[str(library)] = addon
-        addon.bind( self )    
+        library = self.acceptWord()
+        self.useLibrary( str(library) )
+
+    def useLibrary( self, library: str ):
+        self.libraries[library] = registry.bind( library, self )
+        self.used.add( library )
     
     def parseUnUse( self ):
         self.acceptToken( TokenType.DIRECTIVE, Directive.UNUSE )
-        library = self.acceptToken( TokenType.TEXT ).value
+        library = self.acceptWord()
 
         if library not in self.libraries:
             Log.warn( f"No such library {library} loaded, skipped unbind." )
@@ -103,14 +140,18 @@ class Parser:
     def parseTitle( self ):
         directive = self.acceptToken( TokenType.DIRECTIVE, Directive.TITLE )
 
+        args = self.parseArguments( directive )
+        titleText = self.parseText( directive )
+
+        Log.debug( "New title: '%s', args = %s", titleText, args )
+        return Title( directive.line, titleText, args )
+
+    def parseArguments( self, directive ) -> dict:
         args = {}
         while self.nextToken and self.nextToken.type == TokenType.ARGUMENT and self.nextToken.isChildOf( directive ):
             arg = self.parseArgument( directive )
             args[arg[0]] = arg[1]
-        
-        titleText = self.parseText( directive )
-
-        Log.debug( f"New title: '{titleText.lstrip()}', args = {args}" )
+        return args
 
     def parseArgument( self, parent ):
         argument = self.acceptToken( TokenType.ARGUMENT ).value
@@ -118,37 +159,115 @@ class Parser:
         return [argument,value]
 
     def parseText( self, parent ):
-        buffer = "";
+        words = []
         while self.nextToken and self.nextToken.type == TokenType.TEXT:
-            buffer += ' ' + self.acceptToken( TokenType.TEXT ).value
-        return buffer.lstrip()
+            words.append( self.acceptToken( TokenType.TEXT ).value )
+        return ' '.join( words )
+
+    def parseRun( self ) -> Text:
+        """Like parseText, but stops at a change of scope, so the run stays in one paragraph"""
+        first = self.nextToken
+        words = []
+        while self.nextToken and self.nextToken.type == TokenType.TEXT and self.nextToken.scope == first.scope:
+            words.append( self.acceptToken( TokenType.TEXT ).value )
+        text = ' '.join( words )
+        Log.debug( "%s %s", '-' * first.scope, text )
+        return Text( first.line, text )
 
-    def parse( self ) -> list:
-        currentScope = 0
-        root = []
+    def events( self, handler ):
+        """
+        Parses the whole stream, reporting what it finds to 'handler' (see Handler) as it goes rather than building
+        a tree, so nothing is kept once the handler has seen it.
+        """
+        scope = 0 # How many scopes are currently open
+        handler.startDocument()
         while self.nextToken:
-            if( self.nextToken.scope != currentScope and self.nextToken.type != TokenType.BREAK ):
-                while( self.nextToken.scope != currentScope ):
-                    if( self.nextToken.scope > currentScope ):
-                        Log.debug( "<p>" );
-                        currentScope += 1
-                    elif( self.nextToken.scope < currentScope ):
-                        Log.debug( "</p>" );
-                        currentScope -= 1
-                    
-                currentScope = self.nextToken.scope
-
-            if self.nextToken.type == TokenType.DIRECTIVE:
-                self.parseDirective()
-            
-            elif self.nextToken.type == TokenType.TEXT:
-                Log.debug( ('-' * self.nextToken.scope) + ' ' + self.acceptToken(TokenType.TEXT).value )
-            
-            elif self.nextToken.type == TokenType.BREAK:
+            token = self.nextToken
+            if( token.scope != scope and token.type != TokenType.BREAK ):
+                while( token.scope > scope ):
+                    scope += 1
+                    handler.startScope( token.line, scope )
+                while( token.scope < scope ):
+                    handler.endScope( scope )
+                    scope -= 1
+
+            if token.type == TokenType.DIRECTIVE:
+                node = self.parseDirective()
+                if node is None:
+                    pass
+                elif node.__class__ is Title:
+                    handler.title( node )
+                else:
+                    handler.addon( node )
+
+            elif token.type == TokenType.TEXT:
+                handler.text( self.parseRun() )
+
+            elif token.type == TokenType.BREAK:
                 self.acceptToken( TokenType.BREAK )
                 Log.debug( "BREAK" )
+                handler.lineBreak( Break( token.line ) )
 
             else:
-                Log.warn( f"Unknown token: {self.acceptToken( None )}" )
-        
-        return root
\ No newline at end of file
+                Log.warn( "Unknown token: %s", self.acceptToken( None ) )
+
+        while scope:
+            handler.endScope( scope )
+            scope -= 1
+        handler.endDocument()
+
+    def parse( self ) -> Document:
+        builder = TreeBuilder()
+        self.events( builder )
+        return builder.document
+
+class Handler:
+    """
+    Receives a document from Parser.events() in order. Every method does nothing by default, so subclasses only
+    need to implement the events they care about.
+    """
+    def startDocument( self ):
+        pass
+
+    def endDocument( self ):
+        pass
+
+    def startScope( self, line: int, scope: int ):
+        pass
+
+    def endScope( self, scope: int ):
+        pass
+
+    def title( self, node: Title ):
+        pass
+
+    def text( self, node: Text ):
+        pass
+
+    def lineBreak( self, node: Break ):
+        pass
+
+    def addon( self, node ):
+        """Any other node a directive handler returned, typically from an addon"""
+        pass
+
+class TreeBuilder(Handler):
+    """Builds the events back up into a Document, which is what Parser.parse() returns"""
+    def __init__( self ) -> None:
+        self.document = Document( 1 )
+        self.stack = [ self.document ] # Every open container, innermost last
+
+    def startScope( self, line: int, scope: int ):
+        Log.debug( "<p>" )
+        paragraph = Paragraph( line, scope )
+        self.stack[-1].children.append( paragraph )
+        self.stack.append( paragraph )
+
+    def endScope( self, scope: int ):
+        Log.debug( "</p>" )
+        self.stack.pop()
+
+    def title( self, node: Title ):
+        self.stack[-1].children.append( node )
+
+    text = lineBreak = addon = title
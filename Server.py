@@ -0,0 +1,220 @@
+# MIT License
+# 
+# Copyright (c) 2022 Dr John Vidler
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import io
+import json
+import time
+from collections import deque
+from threading import Lock
+from multiprocessing import Pool
+from socketserver import ThreadingMixIn, UnixStreamServer
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from Logging import Log
+from Lexer import Lexer, ENCODING
+from SDMLParser import Parser
+from HTMLGenerator import Generator, EventWriter
+from Addons import registry
+
+MAX_REQUEST = 16 << 20 # Bytes of SDML we'll accept in one request
+LATENCY_WINDOW = 1024  # How many recent requests the latency percentiles are taken over
+
+class InstancePool:
+    """
+    Idle Lexer/Parser pairs, reset and handed out again for each render so a request never pays to build them.
+
+    Every pair has its own buffer, stages and libraries, so pairs in use on different threads never share state.
+    """
+    def __init__( self ) -> None:
+        self.idle = []
+        self.lock = Lock()
+        self.created = 0
+
+    def acquire( self, stream, libraries = () ):
+        with self.lock:
+            pair = self.idle.pop() if self.idle else None
+        if pair is None:
+            lexer = Lexer( stream )
+            self.created += 1
+            return lexer, Parser( lexer, libraries )
+
+        lexer, parser = pair
+        lexer.reset( stream )
+        parser.reset( lexer, libraries )
+        return lexer, parser
+
+    def release( self, lexer: Lexer, parser: Parser ):
+        lexer.close()
+        with self.lock:
+            self.idle.append( (lexer, parser) )
+
+instances = InstancePool() # One per process, so pool workers each have their own
+
+def initWorker():
+    registry.preload()
+
+def render( text: str, libraries = () ) -> str:
+    """Renders one SDML document to a complete HTML page, using a pooled Lexer/Parser pair"""
+    lexer, parser = instances.acquire( io.StringIO( text, newline=None ), libraries )
+    try:
+        chunks = []
+        parser.events( EventWriter( Generator(), chunks.append ) )
+        return ''.join( chunks )
+    finally:
+        instances.release( lexer, parser )
+        Log.flush() # Pool workers may be terminated at any time
+
+class Stats:
+    """Request counters and recent latencies, shared by every request thread"""
+    def __init__( self ) -> None:
+        self.lock = Lock()
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.busy = 0.0
+        self.latencies = deque( maxlen=LATENCY_WINDOW )
+
+    def record( self, seconds: float, bytesIn: int, bytesOut: int, failed: bool = False ):
+        with self.lock:
+            self.requests += 1
+            self.errors += failed
+            self.bytesIn += bytesIn
+            self.bytesOut += bytesOut
+            self.busy += seconds
+            self.latencies.append( seconds )
+
+    def json( self ) -> dict:
+        with self.lock:
+            uptime = time.monotonic() - self.started
+            latencies = sorted( self.latencies )
+            def percentile( p: float ) -> float:
+                return latencies[ min( int( len(latencies) * p ), len(latencies) - 1 ) ] * 1000 if latencies else 0.0
+            return {
+                'uptime': uptime,
+                'requests': self.requests,
+                'errors': self.errors,
+                'bytesIn': self.bytesIn,
+                'bytesOut': self.bytesOut,
+                'requestsPerSecond': self.requests / uptime if uptime else 0.0,
+                'meanMs': self.busy / self.requests * 1000 if self.requests else 0.0,
+                'p50Ms': percentile( 0.5 ),
+                'p95Ms': percentile( 0.95 ),
+                'p99Ms': percentile( 0.99 ),
+                'pooledInstances': instances.created
+            }
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /render with SDML as the body returns the rendered HTML; add ?use=name (repeatable) to bind addons before
+    the first line. GET /stats returns the server's counters as JSON.
+    """
+    protocol_version = "HTTP/1.1" # Keep-alive, so preview tools can reuse one connection
+
+    def reply( self, status: int, body: bytes, contentType: str ):
+        self.send_response( status )
+        self.send_header( "Content-Type", contentType )
+        self.send_header( "Content-Length", str( len(body) ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def do_GET( self ):
+        if urlsplit( self.path ).path == "/stats":
+            self.reply( 200, json.dumps( self.server.stats.json() ).encode(), "application/json" )
+        else:
+            self.reply( 404, b"Not found\n", "text/plain" )
+
+    def do_POST( self ):
+        url = urlsplit( self.path )
+        if url.path != "/render":
+            self.reply( 404, b"Not found\n", "text/plain" )
+            return
+
+        try:
+            length = int( self.headers.get( "Content-Length", 0 ) )
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True # We can't tell where this body ends, so the connection can't be reused
+            self.reply( 400, b"Bad Content-Length\n", "text/plain" )
+            return
+        if length > MAX_REQUEST:
+            self.close_connection = True
+            self.reply( 413, b"Request too large\n", "text/plain" )
+            return
+
+        began = time.perf_counter()
+        body = self.rfile.read( length )
+        libraries = parse_qs( url.query ).get( "use", [] )
+        try:
+            text = body.decode( ENCODING )
+            if self.server.workers:
+                html = self.server.workers.apply( render, ( text, libraries ) )
+            else:
+                html = render( text, libraries )
+            status, output, contentType = 200, html.encode( ENCODING ), f"text/html; charset={ENCODING}"
+        except Exception as e:
+            status, output, contentType = 422, f"{type(e).__name__}: {e}\n".encode( ENCODING ), "text/plain"
+        self.reply( status, output, contentType )
+        self.server.stats.record( time.perf_counter() - began, len(body), len(output), status != 200 )
+
+    def address_string( self ) -> str:
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message( self, format: str, *args ):
+        Log.debug( "%s %s", self.address_string(), format % args )
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind( self ):
+        if os.path.exists( self.server_address ):
+            os.remove( self.server_address ) # A stale socket from a server that didn't shut down cleanly
+        super().server_bind()
+        self.server_name, self.server_port = self.server_address, 0
+
+def serve( address: str, jobs: int = 1 ):
+    """
+    Serves renders on 'address' until interrupted: either host:port (or just a port) for TCP, or a path for a Unix
+    socket. Requests are handled on threads; with more than one job the rendering itself is spread over a pool of
+    worker processes, each keeping its own warm addons and instances.
+    """
+    registry.preload()
+    if os.sep in address:
+        server = UnixHTTPServer( address, RequestHandler )
+    else:
+        host, _, port = address.rpartition( ':' )
+        server = ThreadingHTTPServer( ( host or "127.0.0.1", int( port ) ), RequestHandler )
+    server.stats = Stats()
+    server.workers = Pool( jobs, initializer=initWorker ) if jobs > 1 else None
+    Log.info( f"Serving renders on {address}" )
+    Log.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if server.workers:
+            server.workers.terminate()
+        if os.sep in address and os.path.exists( address ):
+            os.remove( address )
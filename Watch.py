@@ -0,0 +1,226 @@
+# MIT License
+# 
+# Copyright (c) 2022 Dr John Vidler
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import io
+import os
+import re
+import time
+from Logging import Log
+from Lexer import Lexer, ENCODING, lex_handleDirective
+from SDMLParser import Parser
+from Nodes import Document
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+DIRECTIVE_PATTERN = re.compile( lex_handleDirective.prefix )
+FENCE_PATTERN = re.compile( r'\s*(```|~~~)' ) # A fenced code block, as the markdown addon lexes them
+
+class BlockState:
+    """What a block inherits from everything before it: the bound addons and the scope step size"""
+    __slots__ = ( 'libraries', 'scopeStep' )
+
+    def __init__( self, libraries: tuple = (), scopeStep: int = 0 ) -> None:
+        self.libraries = libraries
+        self.scopeStep = scopeStep
+
+    def __eq__( self, other ) -> bool:
+        return self.libraries == other.libraries and self.scopeStep == other.scopeStep
+
+class Block:
+    __slots__ = ( 'start', 'text', 'entry', 'exit', 'result', 'error' )
+
+    def __init__( self, start: int, text: str, entry: BlockState ) -> None:
+        self.start = start
+        self.text = text
+        self.entry = entry
+        self.exit = entry
+        self.result = Document( start )
+        self.error = None
+
+    def move( self, start: int ):
+        """Reuses this block at a new first line, shifting the lines of everything it parsed to match"""
+        offset = start - self.start
+        if offset:
+            self.result.line += offset
+            for node in self.result.walk():
+                if node.line is not None:
+                    node.line += offset
+        self.start = start
+
+    def parse( self ):
+        lexer = Lexer( io.StringIO( self.text ) )
+        lexer.inputLine = self.start - 1
+        lexer.scopeStep = self.entry.scopeStep
+        try:
+            parser = Parser( lexer, self.entry.libraries )
+            self.result = parser.parse()
+            self.exit = BlockState( tuple( parser.libraries ), lexer.scopeStep )
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            Log.error( f"Line {self.start}: {self.error}" )
+
+def splitBlocks( text: str ) -> list:
+    """
+    Splits a document into top-level blocks, returning (first line, text) pairs.
+
+    A block starts at any unindented line that follows a blank line, or that opens a directive. Indented lines are
+    always deeper in scope than whatever came before them, so they never start a block of their own, and nor does
+    anything inside a code fence, since the lexer takes that verbatim up to the closing fence.
+    """
+    blocks = []
+    current = []
+    start = 1
+    previousBlank = True
+    fence = None # The marker of the fence we're inside, if any
+    for number, line in enumerate( text.splitlines( keepends=True ), 1 ):
+        blank = not line.strip()
+        if fence:
+            if line.lstrip().startswith( fence ):
+                fence = None
+        else:
+            if current and not blank and not line[0].isspace() and (previousBlank or DIRECTIVE_PATTERN.match( line )):
+                blocks.append( (start, ''.join( current )) )
+                current = []
+                start = number
+            opening = FENCE_PATTERN.match( line )
+            if opening:
+                fence = opening.group( 1 )
+        current.append( line )
+        previousBlank = blank
+    if current:
+        blocks.append( (start, ''.join( current )) )
+    return blocks
+
+class WatchedDocument:
+    """Holds the parsed blocks of one source, so an edit only re-lexes the blocks that actually changed"""
+    def __init__( self, source: str ) -> None:
+        self.source = source
+        self.blocks = []
+        self.mtime = None
+
+    def update( self ) -> int:
+        """Re-reads the source and reparses what changed, returning how many blocks had to be parsed"""
+        with open( self.source, 'r', encoding=ENCODING ) as f:
+            fresh = splitBlocks( f.read() )
+        old = self.blocks
+
+        # Everything before the first difference is untouched...
+        prefix = 0
+        while prefix < min( len(old), len(fresh) ) and (old[prefix].start, old[prefix].text) == fresh[prefix]:
+            prefix += 1
+
+        # ...and everything after the last difference is too, give or take where it starts
+        suffix = 0
+        while suffix < min( len(old), len(fresh) ) - prefix and old[-1-suffix].text == fresh[-1-suffix][1]:
+            suffix += 1
+
+        blocks = old[:prefix]
+        state = blocks[-1].exit if blocks else BlockState()
+        parsed = 0
+        for index in range( prefix, len(fresh) ):
+            start, text = fresh[index]
+            if index >= len(fresh) - suffix:
+                block = old[ index - len(fresh) + len(old) ]
+                if block.entry == state:
+                    block.move( start )
+                    blocks.append( block )
+                    state = block.exit
+                    continue
+
+            block = Block( start, text, state )
+            block.parse()
+            blocks.append( block )
+            state = block.exit
+            parsed += 1
+
+        self.blocks = blocks
+        return parsed
+
+    def result( self ) -> Document:
+        document = Document( 1 )
+        for block in self.blocks:
+            document.children.extend( block.result.children )
+        return document
+
+class Watcher:
+    """
+    Keeps a WatchedDocument per source and calls onUpdate( document, parsed, seconds ) whenever one changes.
+
+    Sources are re-listed and their mtimes polled every 'interval' seconds; if inotify_simple is installed, we also
+    wake as soon as a watched directory changes rather than waiting out the interval.
+    """
+    def __init__( self, listSources, onUpdate, interval: float = 0.5 ) -> None:
+        self.listSources = listSources
+        self.onUpdate = onUpdate
+        self.interval = interval
+        self.documents = {}
+        self.notify = INotify() if INotify else None
+        self.watched = set()
+
+    def poll( self ):
+        sources = self.listSources()
+        for source in set( self.documents ) - set( sources ):
+            Log.info( f"{source} was removed, no longer watching it" )
+            del self.documents[source]
+
+        for source in sources:
+            document = self.documents.get( source )
+            if document is None:
+                document = self.documents[source] = WatchedDocument( source )
+                self.watch( os.path.dirname( source ) or '.' )
+
+            try:
+                mtime = os.stat( source ).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if mtime == document.mtime:
+                continue
+
+            began = time.perf_counter()
+            try:
+                parsed = document.update()
+            except (OSError, UnicodeDecodeError) as e:
+                # Deleted, or caught half written; either way the next poll will see it again
+                Log.warn( f"Couldn't read {source}, will retry: {type(e).__name__}: {e}" )
+                continue
+            document.mtime = mtime
+            self.onUpdate( document, parsed, time.perf_counter() - began )
+
+    def watch( self, directory: str ):
+        if self.notify and directory not in self.watched:
+            self.notify.add_watch( directory, flags.MODIFY | flags.CLOSE_WRITE | flags.CREATE | flags.DELETE | flags.MOVED_TO )
+            self.watched.add( directory )
+
+    def wait( self ):
+        if self.notify:
+            self.notify.read( timeout=int( self.interval * 1000 ) )
+        else:
+            time.sleep( self.interval )
+
+    def run( self ):
+        while True:
+            self.poll()
+            Log.flush() # We never exit normally, so don't sit on the lines saying what was rebuilt
+            self.wait()
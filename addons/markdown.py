@@ -20,34 +20,246 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import re
+from functools import partial
 from SDMLParser import Parser, Directive
-from Lexer import Token, TokenType
+from Lexer import Token, TokenType, prefixStage
+from Nodes import Node
+from HTMLGenerator import Generator, escape
 
 lexerFunc = None
 
-def lex_findPrefixTokens( lexer, line: str ):
-    line = line.lstrip() # OK, drop any whitespace, we don't care for such things anymore (post-scope)
+# Names for the directives we synthesise. The colon keeps them out of reach of the core '..name:' syntax, so a user's own
+# '..code:' is still an unknown directive rather than quietly becoming one of ours
+ITEM = "markdown:item"
+QUOTE = "markdown:quote"
+RULE = "markdown:rule"
+CODE = "markdown:code"
+ROW = "markdown:row"
+DELIMITER = "markdown:delimiter"
 
-    titleMatch = re.search( '^(#+)[^#]', line )
-    if titleMatch:
-        titleDepth = len( titleMatch.group(1) )
-        lexer.buffer.append( Token( lexer.scope, Directive.TITLE, TokenType.DIRECTIVE, lexer.inputLine ) )
-        lexer.buffer.append( Token( lexer.scope+1, "depth",         TokenType.ARGUMENT,  lexer.inputLine ) )
-        lexer.buffer.append( Token( lexer.scope+1, str(titleDepth), TokenType.TEXT,      lexer.inputLine ) )
-        lexer.buffer.append( Token( lexer.scope+1, "value",         TokenType.ARGUMENT,  lexer.inputLine ) )
-        # The next set of tokens should be the title proper, so we've set the parser up to deal with it here
+# One classifier for every block-level construct, so a line is only scanned once however many we support. The
+# lookahead rejects ordinary text on its first character, which keeps it as cheap as matching headings alone.
+BLOCKS = '|'.join( [
+    r'(?P<mdRule>(?:-[ \t]*){3,}$|(?:\*[ \t]*){3,}$|(?:_[ \t]*){3,}$)',
+    r'(?P<titleDepth>#+)(?=[^#])',
+    r'(?P<mdFence>```|~~~)[ \t]*(?P<mdLanguage>[^\s`]*)',
+    r'(?P<mdBullet>[-*+])(?=\s)',
+    r'(?P<mdNumber>\d+)[.)](?=\s)',
+    r'(?P<mdQuote>>)',
+    r'(?P<mdDelimiter>\|(?:[ \t]*:?-+:?[ \t]*\|)+)[ \t]*$',
+    r'\|(?P<mdCells>.*)$'
+] )
 
-        # Drop the '#' string, so it doesn't get emitted with the title...
-        line = line[titleDepth:]
+class ListBlock(Node):
+    __slots__ = ( 'ordered', 'items' )
 
-    return line
+    def __init__( self, line: int = None, ordered: bool = False, items: list = None ) -> None:
+        super().__init__( line )
+        self.ordered = ordered
+        self.items = items if items is not None else []
+
+class Quote(Node):
+    __slots__ = ( 'text', )
+
+    def __init__( self, line: int = None, text: str = "" ) -> None:
+        super().__init__( line )
+        self.text = text
+
+class Rule(Node):
+    __slots__ = ()
+
+class CodeBlock(Node):
+    __slots__ = ( 'language', 'text' )
+
+    def __init__( self, line: int = None, language: str = None, text: str = "" ) -> None:
+        super().__init__( line )
+        self.language = language
+        self.text = text
+
+class Table(Node):
+    __slots__ = ( 'header', 'rows' )
+
+    def __init__( self, line: int = None, header: list = None, rows: list = None ) -> None:
+        super().__init__( line )
+        self.header = header
+        self.rows = rows if rows is not None else []
+
+def emit( lexer, scope: int, value, type: TokenType ):
+    lexer.buffer.append( Token( scope, value, type, lexer.inputLine ) )
+
+@prefixStage( rf'\s*(?=[-#*+_>|`~\d])(?:{BLOCKS})' )
+def lex_findPrefixTokens( lexer, match ):
+    scope = lexer.scope
+    if match.group('titleDepth'):
+        emit( lexer, scope,   Directive.TITLE,                         TokenType.DIRECTIVE )
+        emit( lexer, scope+1, "depth",                                 TokenType.ARGUMENT )
+        emit( lexer, scope+1, str( len( match.group('titleDepth') ) ), TokenType.TEXT )
+        emit( lexer, scope+1, "value",                                 TokenType.ARGUMENT )
+        # The next set of tokens should be the title proper, so we've set the parser up to deal with it here
+        # (the '#' string is consumed as the prefix, so it doesn't get emitted with the title)
+
+    elif match.group('mdBullet') or match.group('mdNumber'):
+        kind = "bullet" if match.group('mdNumber') is None else "ordered"
+        emit( lexer, scope,   ITEM,    TokenType.DIRECTIVE )
+        emit( lexer, scope+1, "kind",  TokenType.ARGUMENT )
+        emit( lexer, scope+1, kind,    TokenType.TEXT )
+        emit( lexer, scope+1, "value", TokenType.ARGUMENT )
+
+    elif match.group('mdQuote'):
+        emit( lexer, scope,   QUOTE,   TokenType.DIRECTIVE )
+        emit( lexer, scope+1, "value", TokenType.ARGUMENT )
+
+    elif match.group('mdRule'):
+        emit( lexer, scope, RULE, TokenType.DIRECTIVE )
+
+    elif match.group('mdFence'):
+        emit( lexer, scope, CODE, TokenType.DIRECTIVE )
+        language = lexer.matchText( match, 'mdLanguage' )
+        if language:
+            emit( lexer, scope+1, "language", TokenType.ARGUMENT )
+            emit( lexer, scope+1, language,   TokenType.TEXT )
+
+        # Everything up to the closing fence is taken verbatim, ahead of the rest of the lexer
+        lexer.markdownFence = ( lexer.matchText( match, 'mdFence' ), scope )
+        lexer.setStage( 1, lex_fencedLine )
+
+    elif match.group('mdDelimiter'):
+        emit( lexer, scope, DELIMITER, TokenType.DIRECTIVE )
+
+    else:
+        emit( lexer, scope, ROW, TokenType.DIRECTIVE )
+        cells = lexer.matchText( match, 'mdCells' ).rstrip()
+        for cell in (cells[:-1] if cells.endswith( '|' ) else cells).split( '|' ):
+            emit( lexer, scope+1, "cell", TokenType.ARGUMENT )
+            if cell.strip():
+                emit( lexer, scope+1, ' '.join( cell.split() ), TokenType.TEXT )
+
+def lex_fencedLine( lexer, line: str ):
+    fence, scope = lexer.markdownFence
+    if line.lstrip().startswith( fence ):
+        lexer.markdownFence = None
+        lexer.clearStage( 1, lex_fencedLine )
+        return None
+
+    emit( lexer, scope+1, "line", TokenType.ARGUMENT )
+    if line:
+        emit( lexer, scope+1, line, TokenType.TEXT )
+    return None
+
+def following( parser: Parser, directive: Token, names: tuple ) -> bool:
+    """True if the next token continues the same block as 'directive'"""
+    token = parser.nextToken
+    return token is not None and token.type == TokenType.DIRECTIVE and token.value in names and token.scope == directive.scope
+
+def itemKind( parser: Parser ) -> str:
+    token = parser.peek( 2 ) # item, kind, <kind>
+    return token.value if token else None
+
+def parseList( parser: Parser ) -> ListBlock:
+    first = parser.nextToken
+    kind = itemKind( parser )
+    block = ListBlock( first.line, kind == "ordered" )
+
+    # A switch between bullets and numbers starts a new list
+    while following( parser, first, (ITEM,) ) and itemKind( parser ) == kind:
+        item = parser.acceptToken( TokenType.DIRECTIVE, ITEM )
+        block.items.append( parser.parseArguments( item ).get( 'value', '' ) )
+    return block
+
+def parseQuote( parser: Parser ) -> Quote:
+    first = parser.nextToken
+    lines = []
+    while following( parser, first, (QUOTE,) ):
+        quote = parser.acceptToken( TokenType.DIRECTIVE, QUOTE )
+        lines.append( parser.parseArguments( quote ).get( 'value', '' ) )
+    return Quote( first.line, ' '.join( line for line in lines if line ) )
+
+def parseRule( parser: Parser ) -> Rule:
+    return Rule( parser.acceptToken( TokenType.DIRECTIVE, RULE ).line )
+
+def parseCode( parser: Parser ) -> CodeBlock:
+    directive = parser.acceptToken( TokenType.DIRECTIVE, CODE )
+    block = CodeBlock( directive.line )
+    lines = []
+    while parser.nextToken and parser.nextToken.type == TokenType.ARGUMENT and parser.nextToken.isChildOf( directive ):
+        name, value = parser.parseArgument( directive )
+        if name == "language":
+            block.language = value
+        else:
+            lines.append( value )
+    block.text = '\n'.join( lines )
+    return block
+
+def parseTable( parser: Parser ) -> Table:
+    first = parser.nextToken
+    table = Table( first.line )
+    while following( parser, first, (ROW, DELIMITER) ):
+        directive = parser.acceptToken( TokenType.DIRECTIVE )
+        if directive.value == DELIMITER:
+            # The row above a delimiter is the header
+            if table.header is None and len( table.rows ) == 1:
+                table.header = table.rows.pop()
+            continue
+
+        cells = []
+        while parser.nextToken and parser.nextToken.type == TokenType.ARGUMENT and parser.nextToken.isChildOf( directive ):
+            cells.append( parser.parseArgument( directive )[1] )
+        table.rows.append( cells )
+    return table
+
+DIRECTIVES = {
+    ITEM: parseList,
+    QUOTE: parseQuote,
+    RULE: parseRule,
+    CODE: parseCode,
+    ROW: parseTable,
+    DELIMITER: parseTable
+}
+
+def renderList( generator, node: ListBlock ):
+    tag = "ol" if node.ordered else "ul"
+    yield f"<{tag}>\n"
+    for item in node.items:
+        yield f"<li>{escape( item )}</li>\n"
+    yield f"</{tag}>\n"
+
+def renderQuote( generator, node: Quote ):
+    yield f"<blockquote><p>{escape( node.text )}</p></blockquote>\n"
+
+def renderRule( generator, node: Rule ):
+    yield "<hr>\n"
+
+def renderCode( generator, node: CodeBlock ):
+    language = f' class="language-{escape( node.language )}"' if node.language else ''
+    yield f"<pre><code{language}>{escape( node.text )}\n</code></pre>\n"
+
+def renderTable( generator, node: Table ):
+    yield "<table>\n"
+    if node.header is not None:
+        yield "<thead><tr>" + ''.join( f"<th>{escape( cell )}</th>" for cell in node.header ) + "</tr></thead>\n"
+    yield "<tbody>\n"
+    for row in node.rows:
+        yield "<tr>" + ''.join( f"<td>{escape( cell )}</td>" for cell in row ) + "</tr>\n"
+    yield "</tbody>\n</table>\n"
+
+Generator.renderers.update( {
+    ListBlock: renderList,
+    Quote: renderQuote,
+    Rule: renderRule,
+    CodeBlock: renderCode,
+    Table: renderTable
+} )
 
 def bind( parser: Parser ):
     lexer = parser.lexer
+    lexer.lookahead = max( lexer.lookahead, 2 ) # Lists look past the item directive to see what kind they are
 
     lexer.setStage( 25, lex_findPrefixTokens )
+    for name, handler in DIRECTIVES.items():
+        parser.directives[name] = partial( handler, parser )
 
 def unbind( parser: Parser ):
     lexer = parser.lexer
-    lexer.clearStage( 25, lex_findPrefixTokens )
\ No newline at end of file
+    lexer.clearStage( 25, lex_findPrefixTokens )
+    for name in DIRECTIVES:
+        parser.directives.pop( name, None )
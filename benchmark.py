@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# MIT License
+# 
+# Copyright (c) 2022 Dr John Vidler
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Benchmarks the lexer, parser, markdown addon and HTML generator against generated SDML corpora, writing the results
+# as JSON and optionally failing if anything has regressed past a threshold against a stored baseline.
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from Lexer import Lexer, TokenStore, TokenReader
+from SDMLParser import Parser
+from HTMLGenerator import Generator
+
+WORDS = ( "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et "
+          "dolore magna aliqua ut enim ad minim veniam quis nostrud exercitation ullamco laboris nisi" ).split()
+
+def generateCorpus( size: int, depth: int = 3, directives: float = 0.05, headings: float = 0.1,
+                    paragraph: int = 12, markdown: bool = True, seed: int = 0 ) -> str:
+    """
+    Generates roughly 'size' bytes of SDML.
+
+    'depth' is the deepest indent used, 'directives' and 'headings' are the fraction of lines that are '..title:'
+    directives and markdown '#' headings, and 'paragraph' is the mean number of words per text line.
+    """
+    rng = random.Random( seed )
+    lines = [ "..use: markdown", "" ] if markdown else []
+    total = 0
+    while total < size:
+        roll = rng.random()
+        words = ' '.join( rng.choice( WORDS ) for _ in range( max( 1, int( rng.gauss( paragraph, paragraph / 4 ) ) ) ) )
+        if roll < directives:
+            line = f"..title: {words}"
+        elif roll < directives + headings:
+            line = f"{'#' * rng.randint( 1, 6 )} {words}"
+        elif roll < directives + headings + 0.1:
+            line = ""
+        else:
+            line = "    " * rng.randint( 0, depth ) + words
+        lines.append( line )
+        total += len( line ) + 1
+    return '\n'.join( lines ) + '\n'
+
+def lexAll( path: str ) -> int:
+    count = 0
+    lexer = Lexer( path )
+    try:
+        for _ in lexer:
+            count += 1
+    finally:
+        lexer.close()
+    return count
+
+def lexMarkdown( path: str ) -> int:
+    """Lexes with the markdown addon bound, which is what a '..use: markdown' document pays for"""
+    lexer = Lexer( path )
+    try:
+        Parser( lexer, ( "markdown", ) )
+        count = 1
+        while lexer.nextToken():
+            count += 1
+    finally:
+        lexer.close()
+    return count
+
+def parseAll( path: str ):
+    lexer = Lexer( path )
+    try:
+        return Parser( lexer ).parse()
+    finally:
+        lexer.close()
+
+def recordTokens( path: str ) -> TokenStore:
+    """Lexes 'path' through a real parse, addons and all, keeping every token the parser was handed"""
+    store = TokenStore()
+    lexer = Lexer( path, mapped=False ) # So the store doesn't depend on the lexer's map once it's closed
+    try:
+        store.record( lexer )
+        Parser( lexer ).parse()
+    finally:
+        lexer.close()
+    return store
+
+def parseTokens( store: TokenStore ):
+    """Parses an already lexed document, so only the parser itself is timed"""
+    return Parser( TokenReader( store ) ).parse()
+
+class NullWriter:
+    def write( self, text: str ):
+        pass
+
+def renderAll( document ) -> int:
+    chunks = 0
+    writer = NullWriter()
+    for chunk in Generator().chunks( document ):
+        writer.write( chunk )
+        chunks += 1
+    return chunks
+
+def measure( func, arg, size: int, repeats: int ) -> dict:
+    """Best-of-'repeats' wall time, then one more run under tracemalloc for the peak memory"""
+    best = None
+    for _ in range( repeats ):
+        began = time.perf_counter()
+        func( arg )
+        elapsed = time.perf_counter() - began
+        best = elapsed if best is None else min( best, elapsed )
+
+    tracemalloc.start()
+    func( arg )
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return { 'seconds': best, 'mb_per_second': size / (1 << 20) / best, 'peak_bytes': peak }
+
+def runBenchmarks( args ) -> dict:
+    text = generateCorpus( args.size, args.depth, args.directives, args.headings, args.paragraph, seed=args.seed )
+    plain = text.split( '\n', 2 )[2] # The same corpus, without '..use: markdown'
+    size = len( text.encode() )
+
+    with tempfile.TemporaryDirectory() as directory:
+        marked = os.path.join( directory, "corpus.sdml" )
+        unmarked = os.path.join( directory, "plain.sdml" )
+        with open( marked, 'w', encoding='utf-8' ) as f:
+            f.write( text )
+        with open( unmarked, 'w', encoding='utf-8' ) as f:
+            f.write( plain )
+
+        results = {
+            'lexer': measure( lexAll, unmarked, size, args.repeats ),
+            'markdown': measure( lexMarkdown, marked, size, args.repeats ),
+            'parser': measure( parseTokens, recordTokens( marked ), size, args.repeats ),
+            'html': measure( renderAll, parseAll( marked ), size, args.repeats )
+        }
+
+    corpus = { key: getattr( args, key ) for key in ( 'size', 'depth', 'directives', 'headings', 'paragraph', 'seed' ) }
+    return { 'corpus': corpus, 'results': results }
+
+def compare( results: dict, baseline: dict, speed: float, memory: float ) -> list:
+    """Returns a description of every benchmark that regressed by more than the given fractions"""
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline['results'].get( name )
+        if not base:
+            continue
+        if result['mb_per_second'] < base['mb_per_second'] * (1 - speed):
+            regressions.append( f"{name}: {result['mb_per_second']:.2f} MB/s, baseline {base['mb_per_second']:.2f} MB/s" )
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + memory):
+            regressions.append( f"{name}: peak {result['peak_bytes']} bytes, baseline {base['peak_bytes']} bytes" )
+    return regressions
+
+if __name__ == "__main__":
+    args = ArgumentParser( description="Benchmark SDML against a generated corpus" )
+    args.add_argument( "--size", type=int, default=1 << 20, help="corpus size in bytes" )
+    args.add_argument( "--depth", type=int, default=3, help="deepest indent level" )
+    args.add_argument( "--directives", type=float, default=0.05, help="fraction of lines that are directives" )
+    args.add_argument( "--headings", type=float, default=0.1, help="fraction of lines that are markdown headings" )
+    args.add_argument( "--paragraph", type=int, default=12, help="mean words per text line" )
+    args.add_argument( "--seed", type=int, default=0 )
+    args.add_argument( "--repeats", type=int, default=3, help="timed runs per benchmark, the best is kept" )
+    args.add_argument( "-o", "--output", default="benchmark.json", help="where to write the results" )
+    args.add_argument( "--baseline", help="a previous results file to check for regressions against" )
+    args.add_argument( "--speed-threshold", type=float, default=0.10, help="allowed fractional throughput loss" )
+    args.add_argument( "--memory-threshold", type=float, default=0.10, help="allowed fractional peak memory growth" )
+    args = args.parse_args()
+
+    results = runBenchmarks( args )
+    with open( args.output, 'w', encoding='utf-8' ) as f:
+        json.dump( results, f, indent=2 )
+
+    for name, result in results['results'].items():
+        print( f"{name:10} {result['mb_per_second']:8.2f} MB/s {result['peak_bytes'] / (1 << 20):8.2f} MB peak" )
+
+    if args.baseline:
+        with open( args.baseline, 'r', encoding='utf-8' ) as f:
+            regressions = compare( results, json.load( f ), args.speed_threshold, args.memory_threshold )
+        for regression in regressions:
+            print( f"REGRESSION {regression}" )
+        if regressions:
+            sys.exit( 1 )
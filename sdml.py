@@ -27,35 +27,134 @@ import os
 CWD         = os.getcwd()
 BUILD_PATH  = os.getenv("SDML_BUILD_PATH", os.path.join( CWD, "output" ) )
 SOURCE_PATH = os.getenv("SDML_SOURCE_PATH", os.path.join( CWD ) )
+CACHE_PATH  = os.getenv("SDML_CACHE_PATH", os.path.join( BUILD_PATH, ".sdml-cache" ) )
 
-from Logging import Log
-from Lexer import Lexer, TokenType
-from SDMLParser import Parser
+import sys
+import json
+import asyncio
+from argparse import ArgumentParser
+from Logging import Log, parseLevel
+from Build import buildAll, buildAsync, reportErrors, reportCache, outputPath, findSources, Manifest
+from Watch import Watcher
+from HTMLGenerator import Generator
+from Addons import registry
+from Profiler import Profiler
+from Index import HeadingIndex, headings
+from Server import serve
 
-def r_buildFileList( path, output=[] ):
-    for f in os.listdir( path ):
-        if os.path.isdir( os.path.join( path, f ) ):
-            r_buildFileList( os.path.join( path, f ), output )
-            continue
+if __name__ == "__main__":
+    args = ArgumentParser( description="Build SDML documents" )
+    args.add_argument( "-f", "--force", action="store_true", help="rebuild every file, even if it looks up to date" )
+    args.add_argument( "-w", "--watch", action="store_true", help="keep running, rebuilding files as they are edited" )
+    args.add_argument( "--no-cache", action="store_true", help="don't read or write the shared parse cache" )
+    args.add_argument( "-l", "--log-level", type=parseLevel, help="one of error, warning, info or debug (default: $SDML_LOG_LEVEL, or warning)" )
+    args.add_argument( "--profile", action="store_true", help="time every lexer stage, directive and file, and print a report (implies --no-cache)" )
+    args.add_argument( "--profile-json", metavar="PATH", help="also write the profile as JSON" )
+    args.add_argument( "--profile-trace", metavar="PATH", help="also write the profile in Chrome trace format" )
+    args.add_argument( "-i", "--include", action="append", metavar="GLOB", help="only build sources matching this (default: *.sdml)" )
+    args.add_argument( "-x", "--exclude", action="append", default=[], metavar="GLOB", help="skip files and directories matching this" )
+    args.add_argument( "--async", dest="use_async", action="store_true", help="build on one core, overlapping file reads and writes with parsing" )
+    args.add_argument( "-j", "--jobs", type=int, default=1, help="number of worker processes to build with, or 0 for one per core" )
+    args.add_argument( "--serve", metavar="ADDRESS", help="run a render server on [host:]port, or a Unix socket path, instead of building" )
+    args.add_argument( "--find", metavar="PREFIX", help="list indexed titles whose anchors start with this, without building" )
+    args = args.parse_args()
+    if args.log_level is not None:
+        Log.level = args.log_level
+    args.profile = args.profile or bool( args.profile_json or args.profile_trace )
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
 
-        if( f.lower().endswith('.sdml') ):
-            output.append( os.path.join( path, f ) )
-    return output
+    if args.serve:
+        try:
+            serve( args.serve, args.jobs )
+        except KeyboardInterrupt:
+            sys.exit( 0 )
 
+    # Ensure we have somewhere to send stuff
+    if not os.path.exists( BUILD_PATH ):
+        Log.info( "No build output path found, creating it" )
+        os.mkdir( BUILD_PATH )
 
-# Ensure we have somewhere to send stuff
-if not os.path.exists( BUILD_PATH ):
-    Log.info( "No build output path found, creating it" )
-    os.mkdir( BUILD_PATH )
+    index = HeadingIndex( BUILD_PATH )
+    if args.find is not None:
+        for source, output, anchor, depth, title, line in index.prefix( args.find ):
+            print( f"{output}#{anchor}\t{'#' * depth} {title}\t({source}:{line})" )
+        sys.exit( 0 )
 
-# Build a (flat) list of files to parse
-fList = r_buildFileList( SOURCE_PATH )
+    def sources():
+        return findSources( SOURCE_PATH, args.include or ( "*.sdml", ), args.exclude, ( BUILD_PATH, ) )
 
-# Work through the list :)
-for f in fList:
-    lex = Lexer( f )
-    document = Parser( lex )
+    if args.watch:
+        def onUpdate( document, parsed, seconds ):
+            result = document.result()
+            output = outputPath( document.source, SOURCE_PATH, BUILD_PATH )
+            Generator().render( result, output )
+            index.update( document.source, output, headings( result ) )
+            Log.info( "Rebuilt %s (%d of %d blocks) in %.1fms", document.source, parsed, len(document.blocks), seconds * 1000 )
 
-    output = document.parse()
+        try:
+            Watcher( lambda: list( sources() ), onUpdate ).run()
+        except KeyboardInterrupt:
+            sys.exit( 0 )
 
-    print( output )
\ No newline at end of file
+    # Walk the source tree, skipping anything that hasn't changed since it was last built. This is lazy, so the
+    # first files are being built while the rest of the tree is still being walked.
+    manifest = Manifest( BUILD_PATH )
+    indexed = index.sources() # Anything missing from the index is rebuilt too, so a deleted index fills back in
+    found = []
+    def stale():
+        for source in sources():
+            found.append( source )
+            if args.force or source not in indexed or not manifest.isCurrent( source ):
+                yield source
+
+    # Work through the list :)
+    results = []
+    cachePath = None if args.no_cache or args.profile else CACHE_PATH
+    profiler = Profiler()
+    def finished( result ):
+        if result.profile:
+            profiler.merge( result.profile )
+        if not result.error:
+            Log.info( "%s %s", 'Wrote' if result.written else 'Unchanged', result.output )
+            manifest.record( result.source, result.addons, result.output )
+            index.update( result.source, result.output, result.headings )
+        results.append( result )
+
+    if args.use_async:
+        if args.jobs > 1 or args.profile:
+            Log.warn( "--async builds on a single core, without profiling; ignoring -j and --profile" )
+            args.profile = False
+
+        async def build():
+            async for result in buildAsync( stale(), cachePath, SOURCE_PATH, BUILD_PATH ):
+                finished( result )
+        asyncio.run( build() )
+    else:
+        for result in buildAll( stale(), args.jobs, cachePath, SOURCE_PATH, BUILD_PATH, args.profile ):
+            finished( result )
+
+    Log.info( f"{len(found) - len(results)} of {len(found)} files were up to date" )
+
+    # Clear out outputs for deleted sources
+    pruned = manifest.prune( found )
+    for source in pruned:
+        Log.info( f"Source {source} was removed, pruned its output" )
+    index.remove( pruned )
+    index.close()
+    manifest.save()
+    if cachePath:
+        reportCache( results, cachePath )
+    registry.report() # Only covers this process, so shows nothing for -j builds
+
+    if args.profile:
+        print( profiler.table() )
+        if args.profile_json:
+            with open( args.profile_json, 'w', encoding='utf-8' ) as f:
+                json.dump( profiler.json(), f, indent=2 )
+        if args.profile_trace:
+            with open( args.profile_trace, 'w', encoding='utf-8' ) as f:
+                json.dump( profiler.trace(), f )
+
+    if reportErrors( results ):
+        sys.exit( 1 )